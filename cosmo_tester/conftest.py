@@ -1,14 +1,29 @@
+import os
+
 import pytest
 from path import Path
 
+from cosmo_tester.framework import timeline
 from cosmo_tester.framework.config import load_config
+from cosmo_tester.framework.constants import RSYNC_BOOTSTRAPPED_BACKUP_DIR
 from cosmo_tester.framework.logger import get_logger
 from cosmo_tester.framework.test_hosts import Hosts, VM
 from cosmo_tester.framework.util import (
-    SSHKey, reboot_if_required, rsync_restore)
+    SSHKey,
+    file_lock,
+    leave_checkpoints,
+    reboot_if_required,
+    rsync_restore,
+    used_by_later_tests,
+)
 from cosmo_tester.test_suites.cluster.conftest import _get_hosts
 
 
+# Markers (from pytest.ini) for tests sharing a session's VMs
+VM_COUNT_MARKERS = ['one_vm', 'three_vms', 'three_vms_ipv6', 'four_vms',
+                    'six_vms', 'nine_vms']
+
+
 @pytest.fixture(scope='module')
 def logger(request):
     return get_logger(request.module.__name__)
@@ -33,7 +48,18 @@ def session_tmpdir(request, tmpdir_factory, session_logger):
 
 
 @pytest.fixture(scope='session')
-def ssh_key(session_tmpdir, session_logger):
+def ssh_key(session_tmpdir, session_logger, test_config):
+    pool_config = test_config['host_pool']
+    if pool_config['enabled']:
+        # Pooled VMs outlive the session, so they need a key which does too
+        key = SSHKey(session_tmpdir, session_logger,
+                     private_key_path=os.path.expanduser(
+                         pool_config['ssh_key_path']))
+        os.makedirs(os.path.dirname(key.private_key_path), exist_ok=True)
+        with file_lock('{}.lock'.format(key.private_key_path)):
+            if not os.path.exists(key.private_key_path):
+                key.create()
+        return key
     key = SSHKey(session_tmpdir, session_logger)
     key.create()
     return key
@@ -47,6 +73,12 @@ def pytest_addoption(parser):
         default='test_config.yaml',
         help='Location of the test config.',
     )
+    parser.addoption(
+        '--timeline-trace',
+        action='store',
+        default=None,
+        help='Path to write a Chrome trace of test setup phases to.',
+    )
 
 
 @pytest.fixture(scope='session')
@@ -60,6 +92,17 @@ def test_config(request):
     return load_config(logger, config_file_location)
 
 
+def pytest_collection_modifyitems(config, items):
+    # Keep tests which share session VMs on the same xdist worker (when run
+    # with --dist loadgroup), so that each worker only creates the VMs for
+    # the groups it is running.
+    for item in items:
+        for marker in VM_COUNT_MARKERS:
+            if item.get_closest_marker(marker):
+                item.add_marker(pytest.mark.xdist_group(name=marker))
+                break
+
+
 @pytest.hookimpl(tryfirst=True, hookwrapper=True)
 def pytest_runtest_makereport(item, call):
     # execute all other hooks to obtain the report object
@@ -79,6 +122,36 @@ def pytest_runtest_makereport(item, call):
         # No need to handle failed, there's a builtin hook for that
 
 
+def pytest_sessionfinish(session):
+    if hasattr(session.config, 'workeroutput'):
+        # This is an xdist worker, the controller reports all workers' spans
+        session.config.workeroutput['timeline_spans'] = timeline.get_spans()
+        return
+    trace_path = session.config.getoption('--timeline-trace')
+    if trace_path:
+        timeline.export_chrome_trace(trace_path)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    # A worker which crashed has no output
+    timeline.add_spans(
+        getattr(node, 'workeroutput', {}).get('timeline_spans', []),
+        worker=node.gateway.id)
+
+
+def pytest_terminal_summary(terminalreporter):
+    summary = timeline.get_summary()
+    if not summary:
+        return
+    terminalreporter.write_sep('=', 'test setup timeline')
+    terminalreporter.write_line('{:<45} {:>6} {:>10} {:>10}'.format(
+        'phase', 'count', 'total (s)', 'max (s)'))
+    for name, count, total, longest in summary:
+        terminalreporter.write_line('{:<45} {:>6} {:>10.1f} {:>10.1f}'.format(
+            name, count, total, longest))
+
+
 @pytest.fixture(scope='session')
 def session_logger(request):
     return get_logger('session')
@@ -98,11 +171,24 @@ def session_manager(request, ssh_key, session_tmpdir, test_config,
 
 @pytest.fixture(scope='function')
 def image_based_manager(session_manager, session_logger, request):
-    reboot_if_required([session_manager])
-    session_manager.bootstrap()
+    if session_manager.checkpoint == RSYNC_BOOTSTRAPPED_BACKUP_DIR:
+        reboot_if_required([session_manager])
+        session_manager.resume_bootstrapped_checkpoint()
+    else:
+        leave_checkpoints([session_manager])
+        session_manager.bootstrap()
+        if (
+            used_by_later_tests(request, 'image_based_manager')
+            and not session_manager.bootstrapped_checkpoint_saved
+        ):
+            session_manager.save_bootstrapped_checkpoint()
     yield session_manager
     if len(request.session.items) > 1:
-        rsync_restore([session_manager])
+        if session_manager.bootstrapped_checkpoint_saved:
+            rsync_restore([session_manager],
+                          backup_dir=RSYNC_BOOTSTRAPPED_BACKUP_DIR)
+        else:
+            rsync_restore([session_manager])
 
 
 @pytest.fixture(scope='function')
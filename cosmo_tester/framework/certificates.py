@@ -0,0 +1,184 @@
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+import hashlib
+import ipaddress
+import os
+import threading
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+CA_COMMON_NAME = 'cloudify-system-tests-ca'
+KEY_SIZE = 2048
+VALIDITY = timedelta(days=3650)
+
+
+class CertificateFactory(object):
+    """Generates certificates in-process, signed by a shared CA.
+
+    Certificates are cached by their CN, subjectAltNames and signing CA, so
+    requesting the same certificate again just returns the existing files.
+    This is safe to use from several threads at once.
+    """
+
+    def __init__(self, directory):
+        self._directory = str(directory)
+        self._lock = threading.Lock()
+        self._ca = None
+        self._certificates = {}
+
+    def get_ca(self):
+        """Get the paths of the CA cert and key, generating them if needed.
+        An existing CA in the directory (e.g. from an earlier fixture) will be
+        used if there is one.
+        """
+        return self._get_ca()[:2]
+
+    def get_certificate(self, cn, names=()):
+        """Get the paths of a CA-signed cert and key for this CN.
+
+        :param cn: the subject commonName for the certificate
+        :param names: the IPs and hostnames to use for subjectAltNames, in
+                      addition to localhost.
+        """
+        ca_cert_path, ca_key_path, ca_cert, ca_key = self._get_ca()
+        altnames = frozenset(str(name) for name in names) | {
+            '127.0.0.1', 'localhost',
+        }
+        ca_fingerprint = ca_cert.fingerprint(hashes.SHA256())
+        cache_key = (cn, altnames, ca_fingerprint)
+        # Keys are generated outside of the lock, so that several threads
+        # can create different certificates at once. Anyone else wanting the
+        # same certificate meanwhile waits for its future.
+        with self._lock:
+            certificate = self._certificates.get(cache_key)
+            creating = certificate is None
+            if creating:
+                certificate = self._certificates[cache_key] = Future()
+        if creating:
+            digest = hashlib.sha1(
+                repr((cn, sorted(altnames))).encode('utf-8') + ca_fingerprint
+            ).hexdigest()
+            try:
+                certificate.set_result(self._create_certificate(
+                    cn, altnames, ca_cert, ca_key,
+                    name='{cn}-{digest}'.format(cn=cn, digest=digest[:12]),
+                ))
+            except Exception as err:
+                with self._lock:
+                    self._certificates.pop(cache_key)
+                certificate.set_exception(err)
+        return certificate.result()
+
+    def _get_ca(self):
+        with self._lock:
+            if self._ca is None:
+                cert_path = os.path.join(self._directory, 'ca.cert')
+                key_path = os.path.join(self._directory, 'ca.key')
+                if os.path.exists(cert_path) and os.path.exists(key_path):
+                    with open(cert_path, 'rb') as cert_handle:
+                        cert = x509.load_pem_x509_certificate(
+                            cert_handle.read())
+                    with open(key_path, 'rb') as key_handle:
+                        key = serialization.load_pem_private_key(
+                            key_handle.read(), password=None)
+                else:
+                    key = _generate_key()
+                    subject = x509.Name([
+                        x509.NameAttribute(NameOID.COMMON_NAME,
+                                           CA_COMMON_NAME),
+                    ])
+                    cert = _sign(
+                        _builder(subject, subject, key.public_key())
+                        .add_extension(
+                            x509.BasicConstraints(ca=True, path_length=None),
+                            critical=True,
+                        ),
+                        key,
+                    )
+                    _write(cert, key, cert_path, key_path)
+                self._ca = (cert_path, key_path, cert, key)
+            elif not os.path.exists(self._ca[0]):
+                # Rsync restores remove the local copy of a manager's CA
+                _write(self._ca[2], self._ca[3], self._ca[0], self._ca[1])
+            return self._ca
+
+    def _create_certificate(self, cn, altnames, ca_cert, ca_key, name):
+        key = _generate_key()
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+        sans = [x509.DNSName(altname) for altname in sorted(altnames)]
+        for altname in sorted(altnames):
+            try:
+                sans.append(x509.IPAddress(ipaddress.ip_address(altname)))
+            except ValueError:
+                # Not an IP
+                pass
+        cert = _sign(
+            _builder(subject, ca_cert.subject, key.public_key())
+            .add_extension(x509.SubjectAlternativeName(sans), critical=False)
+            .add_extension(
+                x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                    ca_key.public_key()),
+                critical=False,
+            ),
+            ca_key,
+        )
+        cert_path = os.path.join(self._directory, name + '.crt')
+        key_path = os.path.join(self._directory, name + '.key')
+        _write(cert, key, cert_path, key_path)
+        return cert_path, key_path
+
+
+def _generate_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=KEY_SIZE)
+
+
+def _builder(subject, issuer, public_key):
+    now = datetime.utcnow()
+    return x509.CertificateBuilder().subject_name(
+        subject
+    ).issuer_name(
+        issuer
+    ).public_key(
+        public_key
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now - timedelta(days=1)
+    ).not_valid_after(
+        now + VALIDITY
+    ).add_extension(
+        x509.SubjectKeyIdentifier.from_public_key(public_key),
+        critical=False,
+    )
+
+
+def _sign(builder, key):
+    return builder.sign(key, hashes.SHA256())
+
+
+def _write(cert, key, cert_path, key_path):
+    with open(key_path, 'wb') as key_handle:
+        key_handle.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        ))
+    with open(cert_path, 'wb') as cert_handle:
+        cert_handle.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
+_factories = {}
+_factories_lock = threading.Lock()
+
+
+def get_certificate_factory(directory):
+    """Get the certificate factory for this directory, so that certificates
+    are reused by every fixture in the session which uses it.
+    """
+    with _factories_lock:
+        if str(directory) not in _factories:
+            _factories[str(directory)] = CertificateFactory(directory)
+        return _factories[str(directory)]
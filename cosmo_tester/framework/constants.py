@@ -1,5 +1,16 @@
 CLOUDIFY_TENANT_HEADER = 'Tenant'
 
+# How long to wait for an async command on a test host, e.g. a bootstrap
+ASYNC_COMMAND_TIMEOUT = 60 * 60
+
+# Where test hosts are backed up to between tests
+RSYNC_BACKUP_DIR = '/cfy_backup'
+# Where checkpoints of test hosts are kept (e.g. just after bootstrapping), so
+# that later tests can restore them instead of repeating slow setup
+RSYNC_CHECKPOINT_DIR = '/cfy_checkpoints'
+RSYNC_BOOTSTRAPPED_BACKUP_DIR = RSYNC_CHECKPOINT_DIR + '/bootstrapped'
+RSYNC_CLUSTER_BACKUP_DIR = RSYNC_CHECKPOINT_DIR + '/cluster'
+
 SUPPORTED_RELEASES = [
     '5.1.0',
     '5.1.1',  # Keeping this version because here we started better versioning
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 
@@ -6,12 +7,15 @@ import retrying
 from cloudify_rest_client.exceptions import CloudifyClientError
 
 from cosmo_tester.framework.util import (
+    DeploymentCreationError,
     create_deployment,
     delete_deployment,
     get_resource_path,
+    get_rest_rate_limiter,
     prepare_and_get_test_tenant,
     set_client_tenant,
     wait_for_execution,
+    wait_until,
 )
 
 
@@ -126,17 +130,29 @@ class BaseExample(object):
         if wait:
             self.wait_for_deployment_environment_creation()
 
-    def wait_for_deployment_environment_creation(self):
+    def wait_for_deployment_environment_creation(self, timeout=10 * 60):
         self.logger.info('Waiting for deployment env creation.')
-        while True:
+
+        def _created():
             with set_client_tenant(self.manager.client, self.tenant):
                 executions = self.manager.client.executions.list(
                     _include=['status'],
                     deployment_id=self.deployment_id,
                     workflow_id='create_deployment_environment',
                 )
-                if all(exc['status'] == 'terminated' for exc in executions):
-                    break
+            for exc in executions:
+                if (exc['status'] in exc.END_STATES
+                        and exc['status'] != exc.TERMINATED):
+                    raise DeploymentCreationError(
+                        'Deployment env creation for {} ended in state: '
+                        '{}'.format(self.deployment_id, exc['status']))
+            return all(exc['status'] == 'terminated' for exc in executions)
+
+        wait_until(
+            _created, timeout,
+            'deployment env creation for {}'.format(self.deployment_id),
+            rate_limiter=get_rest_rate_limiter(self.manager.client),
+        )
         self.logger.info('Deployment env created.')
 
     def install(self):
@@ -187,17 +203,32 @@ class BaseExample(object):
         if expected_content is None:
             expected_content = self.inputs['content']
 
-        for instance in instances:
-            if instance.node_id == 'file':
-                file_path = path + '_' + instance.id
-                if self.windows:
-                    # Windows data has to be .strip()ed because of CRLF ending
-                    data = self.example_host.get_windows_remote_file_content(
-                        file_path).strip()
-                else:
-                    data = self.example_host.get_remote_file_content(
-                        file_path)
-                assert data.decode('utf-8') == expected_content
+        file_paths = [path + '_' + instance.id for instance in instances
+                      if instance.node_id == 'file']
+        # All of the files are checked with one remote command, as there may
+        # be thousands of them after scaling
+        if self.windows:
+            contents = self.example_host.get_windows_remote_file_contents(
+                file_paths)
+            # Windows data has to be .strip()ed because of CRLF ending
+            mismatched = [
+                file_path for file_path, data in contents.items()
+                if data is None or data.strip() != expected_content
+            ]
+        else:
+            expected_hash = hashlib.sha256(
+                expected_content.encode('utf-8')).hexdigest()
+            hashes = self.example_host.get_remote_file_hashes(file_paths)
+            mismatched = [file_path for file_path, digest in hashes.items()
+                          if digest != expected_hash]
+        assert not mismatched, (
+            '{count} of {total} files were missing or had unexpected '
+            'content, e.g. {examples}'.format(
+                count=len(mismatched),
+                total=len(file_paths),
+                examples=', '.join(mismatched[:5]),
+            )
+        )
 
     # Proxy test has been suffering temporary ssh timeout issues
     @retrying.retry(stop_max_attempt_number=30, wait_fixed=2000)
@@ -1,15 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
 import copy
 from datetime import datetime
 import functools
 import hashlib
+import io
 import json
 import os
 import random
 import re
+import shlex
+import shutil
 import string
 import socket
 import subprocess
 import sys
+import tarfile
+import threading
 import time
 import uuid
 import warnings
@@ -29,14 +36,81 @@ import winrm
 
 from cloudify_rest_client.exceptions import CloudifyClientError
 
-from cosmo_tester.framework import util
-from cosmo_tester.framework.constants import CLOUDIFY_TENANT_HEADER
+from cosmo_tester.framework import timeline, util
+from cosmo_tester.framework.constants import (
+    ASYNC_COMMAND_TIMEOUT,
+    RSYNC_BACKUP_DIR,
+    RSYNC_BOOTSTRAPPED_BACKUP_DIR,
+    RSYNC_CHECKPOINT_DIR,
+)
+from cosmo_tester.framework.exceptions import ProcessExecutionError
 
 HEALTHY_STATE = 'OK'
 RSYNC_LOCATIONS = ['/etc',
                    '/opt',
                    '/var',
                    '/usr']
+# Paths (relative to /) which a restore can change without the host needing a
+# reboot afterwards, as no kernel or service state depends on them.
+RSYNC_NO_REBOOT_PATHS = ('var/log/',
+                         'var/tmp/',
+                         'var/cache/',
+                         'var/spool/',
+                         'var/lib/chrony/',
+                         'var/lib/dhclient/',
+                         'var/lib/NetworkManager/',
+                         'var/lib/rsyslog/',
+                         'var/lib/systemd/')
+# An rsync --itemize-changes line, e.g. '>f.st...... etc/hosts'. Items
+# starting with '.' only had their attributes updated.
+RSYNC_ITEM_RE = re.compile(r'^(\*deleting|[<>ch][fdLDS]\S{9})\s+(.+)$')
+RSYNC_TRANSFERRED_RE = re.compile(
+    r'^Total transferred file size: ([\d,]+) bytes')
+# Runtime state which a restore doesn't reset, captured with each backup (in
+# a dot dir, so that restoring <backup>/* doesn't copy it to /). Firewall
+# rules are restored from it, and if anything else differs after a restore
+# then the host is rebooted instead.
+RUNTIME_STATE_DIR = '.runtime'
+RUNTIME_STATE_COMMANDS = {
+    'addresses': 'ip -br addr',
+    'routes': "ip route show table all | sed 's/ expires [0-9]*sec//'",
+    'ipv6_routes': "ip -6 route show table all | sed 's/ expires [0-9]*sec//'",
+    'rules': 'ip rule',
+    # Only the dynamic entries are flushed
+    'neighbours': 'ip neigh show nud permanent',
+    # Without the counters which change by themselves
+    'sysctl': "sysctl -a 2>/dev/null | grep -Ev '^(fs\\.(aio-nr|dentry-state|"
+              "file-nr|inode-nr|inode-state|quota\\.)|kernel\\.(ns_last_pid|"
+              "perf_event_max_sample_rate|pty\\.nr|random\\.)|"
+              "net\\.netfilter\\.nf_conntrack_count)'",
+    'mounts': 'findmnt -rn -o TARGET,SOURCE,FSTYPE,OPTIONS | sort',
+    'modules': "cut -d ' ' -f 1 /proc/modules | sort",
+}
+# User space processes (the kernel's threads are kthreadd and its children).
+# The same ones must be running as when the backup was taken.
+RUNTIME_PROCESSES_COMMAND = 'ps --ppid 2 -p 2 --deselect -o comm= | sort -u'
+# A connection which has been used more recently than this is assumed to
+# still be alive.
+CONN_IDLE_CHECK_SECONDS = 10
+# How long a single remote wait for an async command's completion marker
+# runs before we check our own deadline and report progress.
+MARKER_WAIT_CHUNK_SECONDS = 60
+# How many files to read in one WinRM command. The whole script is encoded on
+# the command line, which is limited to 32k characters.
+WINDOWS_FILE_BATCH_SIZE = 100
+# Pooled VMs are backed up here when they are created, and restored from here
+# when they are returned to the pool.
+POOL_BACKUP_DIR = '/cfy_pool_backup'
+POOL_DEPLOYMENT_PREFIX = 'pool_'
+# A pooled VM is leased by creating this secret, as creating a secret that
+# already exists will fail.
+POOL_LEASE_SECRET_PREFIX = 'pool-lease-'
+# A VM with an expired lease is removed from the pool by whoever creates this
+# secret for it.
+POOL_RECLAIM_SECRET_PREFIX = 'pool-reclaim-'
+# ssh-keygen rewrites the known_hosts file, so VMs being assigned in parallel
+# must not run it at the same time.
+KNOWN_HOSTS_LOCK = threading.Lock()
 
 
 def only_manager(func):
@@ -54,21 +128,38 @@ def ensure_conn(func):
         if self.windows:
             # We don't maintain a conn for windows currently
             return func(self, *args, **kwargs)
-        if self._conn is None or self._conn.transport is None:
-            _make_connection(self)
-        # SFTP session gets cached and breaks after reboots or conn drops.
-        # Someone has a PR to fabric in-flight since Nov 2021.
-        self._conn._sftp = None
+        _check_connection(self)
         try:
-            self._conn.transport.open_session().close()
-        except Exception as err:
-            self._logger.warning('SSH connection failure: %s', err)
-            _make_connection(self)
-            self._conn.transport.open_session().close()
-        return func(self, *args, **kwargs)
+            result = func(self, *args, **kwargs)
+        except (SSHException, EOFError, OSError):
+            # Make sure the connection is checked before it is next used
+            self._conn_last_used = None
+            raise
+        self._conn_last_used = time.time()
+        return result
     return wrapped
 
 
+def _check_connection(vm):
+    if (
+        vm._conn is None
+        or vm._conn.transport is None
+        or not vm._conn.transport.is_active()
+    ):
+        _make_connection(vm)
+        return
+    if vm._conn_last_used and (
+        time.time() - vm._conn_last_used < CONN_IDLE_CHECK_SECONDS
+    ):
+        return
+    # The connection may have dropped (e.g. due to a reboot) while idle
+    try:
+        vm._conn.transport.open_session().close()
+    except Exception as err:
+        vm._logger.warning('SSH connection failure: %s', err)
+        _make_connection(vm)
+
+
 @retrying.retry(stop_max_attempt_number=5, wait_fixed=3000)
 def _make_connection(vm):
     vm._conn = Connection(
@@ -80,8 +171,45 @@ def _make_connection(vm):
         port=22,
         connect_timeout=3,
     )
+    # The SFTP session is cached by fabric and breaks after reboots or conn
+    # drops, so we only ever reuse it along with the connection it is from.
     vm._conn.open()
     vm._conn.transport.set_keepalive(15)
+    vm._conn_last_used = time.time()
+
+
+class CommandResult(namedtuple('CommandResult',
+                               ['command', 'stdout', 'return_code'])):
+    @property
+    def ok(self):
+        return self.return_code == 0
+
+
+def parse_rsync_restore_log(log):
+    """Get the paths changed and bytes copied from the output of an
+    rsync --itemize-changes --stats restore.
+    """
+    changed_paths = []
+    transferred_bytes = 0
+    for line in log.splitlines():
+        item = RSYNC_ITEM_RE.match(line)
+        if item:
+            changed_paths.append(item.group(2))
+            continue
+        transferred = RSYNC_TRANSFERRED_RE.match(line)
+        if transferred:
+            transferred_bytes = int(transferred.group(1).replace(',', ''))
+    return RsyncRestoreResult(changed_paths, transferred_bytes)
+
+
+class RsyncRestoreResult(namedtuple(
+        'RsyncRestoreResult', ['changed_paths', 'transferred_bytes'])):
+    @property
+    def reboot_required(self):
+        return any(
+            not path.startswith(RSYNC_NO_REBOOT_PATHS)
+            for path in self.changed_paths
+        )
 
 
 class VM(object):
@@ -95,6 +223,8 @@ class VM(object):
         self.should_finalize = True
         self.restservice_expected = False
         self.client = None
+        self._rest_protocol = None
+        self._rest_session = None
         self._test_config = test_config
         self.windows = 'windows' in image_type
         self._tmpdir_base = None
@@ -102,6 +232,10 @@ class VM(object):
         self.image_type = image_type
         self.is_manager = self._is_manager_image_type()
         self.reboot_required = False
+        self._restored_from = None
+        self.bootstrapped_checkpoint_saved = False
+        # The checkpoint this host was last restored to, if any
+        self.checkpoint = None
         self._set_image_details()
         if self.windows:
             self.prepare_for_windows()
@@ -156,6 +290,8 @@ class VM(object):
             self.install_config = copy.deepcopy(self.basic_install_config)
         self._create_conn_script()
         self._conn = None
+        self._conn_last_used = None
+        self._remote_home = None
 
     def _create_conn_script(self):
         script_path = self._tmpdir_base / '{prefix}_{index}'.format(
@@ -173,7 +309,8 @@ class VM(object):
         else:
             # Don't check this call- it might fail due to missing known_hosts
             # file or similar, and we shouldn't fail the test because of that.
-            subprocess.call(['ssh-keygen', '-R', self.ip_address])
+            with KNOWN_HOSTS_LOCK:
+                subprocess.call(['ssh-keygen', '-R', self.ip_address])
             script_content = (
                 'ssh -i {key} -o StrictHostKeyChecking=no {connstr} ${{*}}\n'
             ).format(
@@ -238,6 +375,37 @@ $user.SetInfo()""".format(fw_cmd=add_firewall_cmd,
             'Get-Content -Path {}'.format(path),
             powershell=True).std_out
 
+    def get_windows_remote_file_contents(self, paths):
+        """Get the contents of several files, with one command per batch of
+        paths (the script has to fit on the command line).
+
+        Returns a dict mapping each path to its content, or to None if the
+        file doesn't exist.
+        """
+        contents = {}
+        for start in range(0, len(paths), WINDOWS_FILE_BATCH_SIZE):
+            batch = paths[start:start + WINDOWS_FILE_BATCH_SIZE]
+            result = self.run_command(
+                '$contents = @{{}}\n'
+                'foreach ($path in @({paths})) {{\n'
+                '  if (Test-Path -Path $path -PathType Leaf) {{\n'
+                '    $contents[$path] = [IO.File]::ReadAllText($path)\n'
+                '  }}\n'
+                '}}\n'
+                'ConvertTo-Json -Compress -InputObject $contents'.format(
+                    # Single quoted strings will not be interpreted
+                    paths=', '.join(
+                        "'{}'".format(path.replace("'", "''"))
+                        for path in batch
+                    ),
+                ),
+                powershell=True,
+            )
+            found = json.loads(result.std_out.decode('utf-8') or '{}')
+            for path in batch:
+                contents[path] = found.get(path)
+        return contents
+
     # We're allowing about 5 minutes in case of /really/ slow VM start/restart
     @retrying.retry(stop_max_attempt_number=100, wait_fixed=3000)
     def wait_for_ssh(self):
@@ -326,25 +494,15 @@ print('{{}} {{}}'.format(distro, codename).lower())
     @ensure_conn
     def get_remote_file(self, remote_path, local_path):
         """ Dump the contents of the remote file into the local path """
-        # Similar to the way fabric1 did it
-        remote_tmp = '/tmp/' + hashlib.sha1(
-            remote_path.encode('utf-8')).hexdigest()
-        self.run_command(
-            'cp {} {}'.format(remote_path, remote_tmp),
-            use_sudo=True,
-        )
-        self.run_command(
-            'chmod 444 {}'.format(remote_tmp),
-            use_sudo=True,
-        )
         local_dir = os.path.dirname(local_path)
         if not os.path.exists(local_dir):
             os.makedirs(local_dir)
 
-        self._conn.get(
-            remote_tmp,
-            local_path,
-        )
+        # Streamed over a single channel so that we don't need to stage a
+        # readable copy of the file first.
+        with open(local_path, 'wb') as local_handle:
+            self._exec_binary('sudo cat {}'.format(remote_path),
+                              output=local_handle)
 
     @ensure_conn
     def put_remote_file(self, remote_path, local_path):
@@ -354,26 +512,80 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 content = fh.read()
             self.put_remote_file_content(remote_path, content)
         else:
-            remote_tmp = '/tmp/' + hashlib.sha1(
-                remote_path.encode('utf-8')).hexdigest()
-            self.run_command(
-                'rm -rf {}'.format(remote_tmp),
-                use_sudo=True,
-            )
-            # Similar to the way fabric1 did it
-            self._conn.put(
-                local_path,
-                remote_tmp,
-            )
-            self.run_command(
-                'mkdir -p {}'.format(
-                    os.path.dirname(remote_path),
-                ),
-                use_sudo=True,
-            )
-            self.run_command(
-                'mv {} {}'.format(remote_tmp, remote_path),
-                use_sudo=True,
+            self.put_remote_files({remote_path: local_path})
+
+    @ensure_conn
+    def put_remote_files(self, files):
+        """Dump the contents of local files into remote paths.
+
+        :param files: Dict mapping remote paths to the local paths to upload.
+        On linux, the files are streamed as one tar archive and extracted with
+        sudo in a single command.
+        """
+        if self.windows:
+            for remote_path, local_path in files.items():
+                self.put_remote_file(remote_path, local_path)
+            return
+
+        remote_paths = [self._get_remote_abs_path(remote_path)
+                        for remote_path in files]
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for remote_path, local_path in zip(remote_paths, files.values()):
+                tar.add(str(local_path), arcname=remote_path.lstrip('/'),
+                        recursive=False)
+
+        # Files end up owned by us, as they would with a normal upload
+        self._exec_binary(
+            'sudo tar -xf - -C / --no-same-owner '
+            '&& sudo chown {user}: {paths}'.format(
+                user=self.username,
+                paths=' '.join(shlex.quote(path) for path in remote_paths),
+            ),
+            data=archive.getvalue(),
+        )
+
+    def _get_remote_abs_path(self, remote_path):
+        if remote_path.startswith('/'):
+            return remote_path
+        if self._remote_home is None:
+            self._remote_home = self.run_command(
+                'echo $HOME', hide_stdout=True).stdout.strip()
+        if remote_path.startswith('~/'):
+            remote_path = remote_path[2:]
+        return os.path.join(self._remote_home, remote_path)
+
+    def _exec_binary(self, command, data=None, output=None):
+        """Run a command on its own channel, without decoding its input or
+        output, which would break binary data.
+        """
+        stdin, stdout, stderr = self._conn.client.exec_command(command)
+
+        def _write_input():
+            if data:
+                stdin.write(data)
+                stdin.flush()
+            stdin.channel.shutdown_write()
+
+        # Input is written and stderr is read while stdout is being read, as
+        # the command will stop if any of those fill the channel's window.
+        errors = io.BytesIO()
+        workers = [
+            threading.Thread(target=_write_input, daemon=True),
+            threading.Thread(target=shutil.copyfileobj,
+                             args=(stderr, errors), daemon=True),
+        ]
+        for worker in workers:
+            worker.start()
+        shutil.copyfileobj(stdout, output or io.BytesIO())
+        status = stdout.channel.recv_exit_status()
+        for worker in workers:
+            worker.join()
+        if status != 0:
+            raise ProcessExecutionError(
+                'Failed running command: {} ({})'.format(
+                    command, errors.getvalue().decode('utf-8', 'replace')),
+                status,
             )
 
     def get_remote_file_content(self, remote_path):
@@ -388,6 +600,45 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 os.unlink(tmp_local_path)
         return content
 
+    @ensure_conn
+    def get_remote_file_hashes(self, remote_paths, truncate_sizes=None):
+        """Get the sha256 of several remote files with a single command.
+
+        The paths are sent on stdin, so there is no limit on how many can be
+        checked at once. Returns a dict mapping each path to its hex digest,
+        or to None if the file couldn't be read.
+
+        :param truncate_sizes: Optional dict mapping paths to the size they
+                               should be truncated to (if they are larger)
+                               before they are hashed, e.g. to ignore anything
+                               logged after a copy of them was taken.
+        """
+        remote_paths = list(remote_paths)
+        truncate_sizes = truncate_sizes or {}
+        data = []
+        for path in remote_paths:
+            data.append(str(truncate_sizes.get(path, '')).encode('utf-8'))
+            data.append(path.encode('utf-8'))
+        script = (
+            'while IFS= read -r -d "" size && IFS= read -r -d "" path; do\n'
+            '  [[ -z "$size" ]] || truncate -c -s "<$size" -- "$path"\n'
+            '  printf "%s\\0" "$path"\n'
+            # sha256sum fails for missing files, but still hashes the rest
+            'done 2>/dev/null | xargs -0 -r sha256sum -- 2>/dev/null\n'
+            'true'
+        )
+        output = io.BytesIO()
+        self._exec_binary(
+            'sudo bash -c {}'.format(shlex.quote(script)),
+            data=b''.join(item + b'\0' for item in data),
+            output=output,
+        )
+        hashes = dict.fromkeys(remote_paths)
+        for line in output.getvalue().decode('utf-8').splitlines():
+            digest, path = line.split('  ', 1)
+            hashes[path] = digest
+        return hashes
+
     def put_remote_file_content(self, remote_path, content):
         if self.windows:
             self.run_command(
@@ -438,6 +689,66 @@ print('{{}} {{}}'.format(distro, codename).lower())
             else:
                 return self._conn.run(command, warn=warn_only, hide=hide)
 
+    @ensure_conn
+    def run_commands(self, commands, use_sudo=False, warn_only=False,
+                     hide_stdout=False):
+        """Run a sequence of commands, using one remote shell on linux.
+
+        Returns a CommandResult for each command that was run. Unless
+        warn_only is set, no more commands are run after one fails and a
+        ProcessExecutionError is raised.
+        """
+        if self.windows:
+            results = []
+            for command in commands:
+                result = self.run_command(command, warn_only=True)
+                results.append(CommandResult(command, result.std_out,
+                                             result.status_code))
+                if not (warn_only or results[-1].ok):
+                    break
+        else:
+            marker = 'command-result-{}'.format(uuid.uuid4().hex)
+            script = ['set +e']
+            for command in commands:
+                # Commands must not read the rest of the script from stdin.
+                # The extra echo makes sure the marker is on its own line.
+                script.append('( {} ) </dev/null'.format(command))
+                script.append('rc=$?; echo; echo "{} $rc"'.format(marker))
+                if not warn_only:
+                    script.append('[[ $rc -eq 0 ]] || exit $rc')
+            shell = 'sudo bash -s' if use_sudo else 'bash -s'
+            output = self._conn.run(
+                shell, in_stream=io.StringIO('\n'.join(script) + '\n'),
+                warn=True, hide='stdout',
+            ).stdout
+
+            results = []
+            for command in commands:
+                if marker not in output:
+                    break
+                stdout, output = output.split(marker + ' ', 1)
+                return_code, output = output.split('\n', 1)
+                results.append(CommandResult(command, stdout[:-1],
+                                             int(return_code)))
+
+        for result in results:
+            if not hide_stdout:
+                self._logger.info('Ran `%s` (exit code %d): %s',
+                                  result.command, result.return_code,
+                                  result.stdout)
+            if not (warn_only or result.ok):
+                raise ProcessExecutionError(
+                    'Failed running command: {}'.format(result.command),
+                    result.return_code,
+                )
+        if len(results) < len(commands) and not warn_only:
+            raise ProcessExecutionError(
+                'Failed running commands: {}'.format(
+                    ', '.join(commands[len(results):]),
+                )
+            )
+        return results
+
     @property
     @only_manager
     def mgr_password(self):
@@ -528,22 +839,30 @@ print('{{}} {{}}'.format(distro, codename).lower())
                    ['database', 'manager', 'queue'])
 
     @only_manager
-    def start_manager_services(self):
+    def start_manager_services(self, configs=None):
+        """Start the services of these installed configs, or of all of them.
+        """
         if not self.is_configured():
             self._logger.info('No services configured')
             return
-        for config_name in self.get_installed_configs():
+        if configs is None:
+            configs = self.get_installed_configs()
+        for config_name in configs:
             config_path = self._get_config_path(config_name)
             self._logger.info('Starting services using {}'.format(
                 config_path))
             self.run_command('cfy_manager start -c {}'.format(config_path))
 
     @only_manager
-    def stop_manager_services(self):
+    def stop_manager_services(self, configs=None):
+        """Stop the services of these installed configs, or of all of them.
+        """
         if not self.is_configured():
             self._logger.info('No services configured')
             return
-        for config_name in self.get_installed_configs():
+        if configs is None:
+            configs = self.get_installed_configs()
+        for config_name in configs:
             config_path = self._get_config_path(config_name)
             self._logger.info('Stopping services using {}'.format(
                 config_path))
@@ -552,6 +871,7 @@ print('{{}} {{}}'.format(distro, codename).lower())
     @only_manager
     def teardown(self, kill_certs=True):
         self._logger.info('Tearing down using any installed configs')
+        self._rest_protocol = None
         if self.is_configured():
             for config_name in self.get_installed_configs():
                 config_path = self._get_config_path(config_name)
@@ -635,6 +955,7 @@ print('{{}} {{}}'.format(distro, codename).lower())
         return '/etc/cloudify/config.yaml'
 
     @only_manager
+    @timeline.traced
     def bootstrap(self, upload_license=False,
                   blocking=True, restservice_expected=True, config_name=None,
                   include_sanity=False):
@@ -649,23 +970,19 @@ print('{{}} {{}}'.format(distro, codename).lower())
             self.apply_override('cloudify_manager_install')
 
         self.restservice_expected = restservice_expected
+        self._rest_protocol = None
         install_config = self._create_config_file(
             upload_license and self._test_config['premium'])
 
         # If we leave this lying around on a compact cluster, we think we
         # finished bootstrapping every component after the first as soon
         # as we check it, because the first component did finish.
-        self.run_command('rm -f /tmp/bootstrap_complete')
-
-        self.run_command('mkdir -p /tmp/bs_logs')
-        self.put_remote_file(
-            '/tmp/cloudify.conf',
-            install_config,
-        )
+        self.run_commands(['rm -f /tmp/bootstrap_complete',
+                           'mkdir -p /tmp/bs_logs'])
+        bootstrap_files = {'/tmp/cloudify.conf': install_config}
         if upload_license:
-            self.put_remote_file(
-                '/tmp/test_valid_paying_license.yaml',
-                util.get_resource_path('test_valid_paying_license.yaml'),
+            bootstrap_files['/tmp/test_valid_paying_license.yaml'] = (
+                util.get_resource_path('test_valid_paying_license.yaml')
             )
 
         if config_name:
@@ -695,16 +1012,13 @@ print('{{}} {{}}'.format(distro, codename).lower())
             self.ip_address,
         )
         install_file.write_text(install_command)
-        self.put_remote_file('/tmp/bootstrap_script', install_file)
+        bootstrap_files['/tmp/bootstrap_script'] = install_file
+        self.put_remote_files(bootstrap_files)
 
         self.run_command('nohup bash /tmp/bootstrap_script &>/dev/null &')
 
         if blocking:
-            while True:
-                if self.bootstrap_is_complete():
-                    break
-                else:
-                    time.sleep(5)
+            self.wait_for_bootstrap()
 
     @only_manager
     def bootstrap_is_complete(self):
@@ -777,13 +1091,13 @@ print('{{}} {{}}'.format(distro, codename).lower())
         self._logger.info('Checking for starter service')
 
         # If we don't wait for this then tests get a bit racier
-        self.run_command(
+        self.run_commands([
             "systemctl status cloudify-starter 2>&1"
-            "| grep -E '(status=0/SUCCESS)|(could not be found)'")
-        # ...and apparently we're misnaming it at the moment
-        self.run_command(
+            "| grep -E '(status=0/SUCCESS)|(could not be found)'",
+            # ...and apparently we're misnaming it at the moment
             "systemctl status cfy-starter 2>&1"
-            "| grep -E '(status=0/SUCCESS)|(could not be found)'")
+            "| grep -E '(status=0/SUCCESS)|(could not be found)'",
+        ])
 
         self._logger.info('Checking manager status')
         try:
@@ -794,6 +1108,7 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 self._logger.info(
                     'Detected that SSL was required, '
                     'updating certs and client.')
+                self._rest_protocol = 'https'
                 self.client = self.get_rest_client()
             raise
 
@@ -822,17 +1137,13 @@ print('{{}} {{}}'.format(distro, codename).lower())
         tenant = tenant or test_mgr_conf['tenant']
 
         if proto == 'auto':
-            proto = 'http'
-            ssl_check = requests.get(
-                'http://{}/api/v3.1/status'.format(self.ip_address))
-            self._logger.info('Rest client generation SSL check response: %s',
-                              ssl_check.text)
-            if 'SSL_REQUIRED' in ssl_check.text:
-                proto = 'https'
+            proto = self._get_rest_protocol()
 
         if proto == 'https' and download_ca:
             self.download_rest_ca()
 
+        if self._rest_session is None:
+            self._rest_session = util.create_rest_session()
         return util.create_rest_client(
             self.ip_address,
             username=username,
@@ -840,8 +1151,25 @@ print('{{}} {{}}'.format(distro, codename).lower())
             tenant=tenant,
             cert=self.api_ca_path,
             protocol=proto,
+            session=self._rest_session,
         )
 
+    @only_manager
+    def _get_rest_protocol(self):
+        """Get whether the manager requires SSL, checking only the first
+        time after it is bootstrapped or restored.
+        """
+        if self._rest_protocol is None:
+            ssl_check = requests.get(
+                'http://{}/api/v3.1/status'.format(self.ip_address))
+            self._logger.info('Rest client generation SSL check response: %s',
+                              ssl_check.text)
+            if 'SSL_REQUIRED' in ssl_check.text:
+                self._rest_protocol = 'https'
+            else:
+                self._rest_protocol = 'http'
+        return self._rest_protocol
+
     @only_manager
     def download_rest_ca(self, force=False):
         self.api_ca_path = self._tmpdir / self.server_id + '_api.crt'
@@ -857,10 +1185,9 @@ print('{{}} {{}}'.format(distro, codename).lower())
             '/etc/cloudify/ssl/cloudify_internal_ca_cert.pem',
             self.api_ca_path,
         )
-        # close the current restclient session to force making a new connection
-        # using the new certificate, on first use after this call
-        if self.client:
-            self.client._client._session.close()
+        # The session shared by this manager's clients is left open: new
+        # connections load the CA from this path when they are made, and the
+        # manager drops any old ones when it restarts with a new certificate.
 
     @only_manager
     def clean_local_rest_ca(self):
@@ -898,6 +1225,8 @@ print('{{}} {{}}'.format(distro, codename).lower())
 
         self._logger.info('Adding extra NICs...')
 
+        nic_files = {}
+        nic_commands = []
         for i in range(0, len(self.networks)):
             dev = f'eth{i}'
             network_file_path = self._tmpdir / 'network_cfg_{}'.format(i)
@@ -906,15 +1235,16 @@ print('{{}} {{}}'.format(distro, codename).lower())
 
             with open(network_file_path, 'w') as conf_handle:
                 conf_handle.write(config_content)
-            self.put_remote_file(
-                f'/etc/sysconfig/network-scripts/ifcfg-{dev}',
-                network_file_path,
+            nic_files[f'/etc/sysconfig/network-scripts/ifcfg-{dev}'] = (
+                network_file_path
             )
             # ifup isn't on RH8, ip link set on RH7 doesn't set IPs
             if self._test_config['test_manager']['distro'] == 'rhel-8':
-                self.run_command(f'ip link set {dev} up', use_sudo=True)
+                nic_commands.append(f'ip link set {dev} up')
             else:
-                self.run_command(f'ifup {dev}', use_sudo=True)
+                nic_commands.append(f'ifup {dev}')
+        self.put_remote_files(nic_files)
+        self.run_commands(nic_commands, use_sudo=True)
 
     def _is_manager_image_type(self):
         if self.image_type == 'master':
@@ -988,18 +1318,35 @@ print('{{}} {{}}'.format(distro, codename).lower())
                 self._test_config['test_os_usernames'][username_key]
             )
 
-    def rsync_backup(self):
+    def rsync_backup(self, backup_dir=RSYNC_BACKUP_DIR):
         self.wait_for_ssh()
         self._logger.info(
             'Creating Rsync backup for host {}. Might take up to 5 '
             'minutes...'.format(self.deployment_id))
-        self.run_command("mkdir /cfy_backup", use_sudo=True)
-        self.run_command("chmod o+r /cfy_backup", use_sudo=True)
+        self.run_commands(['rm -f /tmp/rsync_backup_complete '
+                           '/tmp/rsync_backup_failed',
+                           f'mkdir -p {backup_dir}',
+                           f'chmod o+r {backup_dir}'],
+                          use_sudo=True)
         rsync_backup_file = self._tmpdir / 'rsync_backup_{0}'.format(
             self.ip_address)
         locations = ' '.join(RSYNC_LOCATIONS)
+        state_dir = os.path.join(backup_dir, RUNTIME_STATE_DIR)
+        capture_commands = [
+            f'rm -rf {state_dir}',
+            f'mkdir -p {state_dir}',
+            f'iptables-save > {state_dir}/iptables',
+            f'ip6tables-save > {state_dir}/ip6tables',
+            f'{RUNTIME_PROCESSES_COMMAND} > {state_dir}/processes',
+        ] + [
+            f'{command} > {state_dir}/{name}'
+            for name, command in RUNTIME_STATE_COMMANDS.items()
+        ]
         backup_commands = (
-            f'sudo rsync -aAHX {locations} /cfy_backup '
+            # If this fails, restores from the backup will just reboot
+            'sudo bash -c {capture} '.format(
+                capture=shlex.quote(' && '.join(capture_commands)))
+            + f'; sudo rsync -aAHX {locations} {backup_dir} '
             '> /tmp/rsync_backup.log 2>&1 '
             '; res=$? '
             # An exit code of 24 means files vanished during copy. This is
@@ -1014,32 +1361,148 @@ print('{{}} {{}}'.format(distro, codename).lower())
         self.put_remote_file('/tmp/rsync_backup_script', rsync_backup_file)
         self.run_command('nohup bash /tmp/rsync_backup_script &>/dev/null &')
 
-    def rsync_restore(self):
+    def rsync_restore(self, backup_dir=RSYNC_BACKUP_DIR):
+        self._restored_from = backup_dir
+        if backup_dir.startswith(RSYNC_CHECKPOINT_DIR + '/'):
+            self.checkpoint = backup_dir
+        else:
+            self.checkpoint = None
         # Revert install config to avoid leaking state between tests
         if self.is_manager:
             self.install_config = copy.deepcopy(self.basic_install_config)
         if self.is_manager:
+            self._rest_protocol = None
             self.stop_manager_services()
-            self._logger.info('Cleaning profile/CA dir from home dir')
-            self.run_command('rm -rf ~/.cloudify*')
-            self._logger.info('Cleaning root cloudify profile')
-            self.run_command('sudo rm -rf /root/.cloudify')
+            self._logger.info('Cleaning profile/CA dirs from home dir and '
+                              'root cloudify profile')
+            self.run_commands(['rm -rf ~/.cloudify*',
+                               'sudo rm -rf /root/.cloudify'])
             self.clean_local_rest_ca()
         self._logger.info(
             'Restoring from an Rsync backup for host {}. Might take '
             'up to 1 minute...'.format(self.deployment_id))
         rsync_restore_file = self._tmpdir / 'rsync_restore_{0}'.format(
             self.ip_address)
+        # Only changed files are copied, and each change is itemized so that
+        # we can tell afterwards whether the host needs a reboot.
         rsync_restore_file.write_text(
-            "(sudo rsync -aAHX /cfy_backup/* / --delete "
+            "(sudo rsync -aAHX --itemize-changes --stats "
+            f"{backup_dir}/* / --delete "
             "> /tmp/rsync_restore.log 2>&1 "
             "&& touch /tmp/rsync_restore_complete) "
             "|| touch /tmp/rsync_restore_failed &")
         self.put_remote_file('/tmp/rsync_restore_script',
                              rsync_restore_file)
-        self.run_command('nohup bash /tmp/rsync_restore_script '
+        self.run_command('rm -f /tmp/rsync_restore_complete '
+                         '/tmp/rsync_restore_failed '
+                         '&& nohup bash /tmp/rsync_restore_script '
                          '&>/dev/null &')
 
+    def get_rsync_restore_result(self):
+        """Get the paths changed and bytes copied by the last rsync restore."""
+        return parse_rsync_restore_log(
+            self.get_remote_file_content('/tmp/rsync_restore.log'))
+
+    def reset_runtime_state(self):
+        """Reset what a reboot would have after the last rsync restore: temp
+        files, firewall rules and the neighbour cache.
+
+        Returns False if the host still needs a reboot, because other
+        runtime state (e.g. routes, sysctls, mounts, or processes a test
+        started or stopped) differs from when the backup was taken, or the
+        backup didn't record it.
+        """
+        state_dir = os.path.join(self._restored_from, RUNTIME_STATE_DIR)
+        self.run_command('rm -rf /tmp/*', warn_only=True, use_sudo=True)
+        script = [
+            f'[[ -d {state_dir} ]]',
+            f'iptables-restore < {state_dir}/iptables',
+            f'ip6tables-restore < {state_dir}/ip6tables',
+            'ip neigh flush all',
+        ]
+        for name, command in RUNTIME_STATE_COMMANDS.items():
+            script.append(f'({command}) | cmp -s {state_dir}/{name} -')
+        script.extend([
+            # Listed before comparing so that comm and grep aren't included
+            f'processes=$({RUNTIME_PROCESSES_COMMAND})',
+            f'! comm -3 {state_dir}/processes - <<< "$processes" '
+            '| grep -q .',
+        ])
+        return self.run_command(
+            'sudo bash -c {}'.format(shlex.quote(' && '.join(script))),
+            warn_only=True,
+        ).ok
+
+    @only_manager
+    @timeline.traced
+    def save_bootstrapped_checkpoint(self):
+        """Back up this manager as it is just after bootstrapping, so that
+        later tests can restore it to this state instead of bootstrapping.
+        """
+        # Services are stopped so that their data is consistent in the backup
+        self.stop_manager_services()
+        self.rsync_backup(backup_dir=RSYNC_BOOTSTRAPPED_BACKUP_DIR)
+        self.wait_for_async_command('Rsync backup')
+        self.start_manager_services()
+        self.wait_for_manager()
+        self.bootstrapped_checkpoint_saved = True
+
+    @only_manager
+    @timeline.traced
+    def resume_bootstrapped_checkpoint(self):
+        """Start a manager which was restored to its bootstrapped state."""
+        self.start_manager_services()
+        # The CA may have been regenerated since we last downloaded it
+        self.client = self.get_rest_client()
+        self.wait_for_manager()
+
+    @timeline.traced
+    def wait_for_bootstrap(self, timeout=ASYNC_COMMAND_TIMEOUT):
+        """Wait for a non-blocking bootstrap to finish."""
+        self._wait_for_marker(
+            'bootstrap', 'Bootstrap', timeout,
+            progress_command=(
+                'tail -n5 /tmp/bs_logs/* || echo Waiting for logs'),
+        )
+        return self.bootstrap_is_complete()
+
+    def wait_for_async_command(self, process_name,
+                               timeout=ASYNC_COMMAND_TIMEOUT):
+        """Wait for an async command (e.g. 'Rsync backup') to finish."""
+        with timeline.span(process_name, self.deployment_id):
+            self._wait_for_marker(process_name.replace(' ', '_').lower(),
+                                  process_name, timeout)
+        return self.async_command_is_complete(process_name)
+
+    def _wait_for_marker(self, marker, process_name, timeout,
+                         progress_command=None):
+        """Wait for /tmp/<marker>_complete or /tmp/<marker>_failed.
+
+        The checks run on the host, so this needs one SSH command for each
+        MARKER_WAIT_CHUNK_SECONDS of waiting rather than one per check.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                raise RuntimeError(
+                    '{0} did not complete in time on {1}.'.format(
+                        process_name, self.friendly_name))
+            result = self.run_command(
+                "timeout {timeout} bash -c 'until [[ -f /tmp/{marker}_complete"
+                " || -f /tmp/{marker}_failed ]]; do sleep 1; done'".format(
+                    timeout=min(remaining, MARKER_WAIT_CHUNK_SECONDS),
+                    marker=marker,
+                ),
+                warn_only=True,
+            )
+            if result.ok:
+                return
+            self._logger.info('Still performing {0} on host {1}...'
+                              .format(process_name, self.friendly_name))
+            if progress_command:
+                self.run_command(progress_command, warn_only=True)
+
     def async_command_is_complete(self, process_name):
         unfriendly_name = process_name.replace(' ', '_').lower()
         result = self.run_command(
@@ -1108,11 +1571,13 @@ class Hosts(object):
         self._request = request
         self.tenant = None
         self.deployments = []
-        self.blueprints = []
+        # Blueprint IDs on the infrastructure manager, by blueprint name
+        self._blueprint_ids = {}
         self.test_identifier = None
         self._test_vm_installs = {}
-        self._test_vm_uninstalls = {}
         self._platform_resource_ids = {}
+        # Indexes of instances leased from the host pool, with their VM IDs
+        self._pool_leases = {}
 
         self.multi_net = multi_net
         self.vm_net_mappings = vm_net_mappings or {}
@@ -1133,6 +1598,7 @@ class Hosts(object):
             password=infra_mgr_config['admin_password'],
             cert=infra_mgr_config['ca_cert'],
             protocol='https' if infra_mgr_config['ca_cert'] else 'http',
+            session=util.create_rest_session(),
         )
 
         self._infra_mgr_version = int(
@@ -1143,12 +1609,13 @@ class Hosts(object):
         else:
             self.server_flavor = self._test_config.platform['linux_size']
 
+    @timeline.traced
     def create(self, use_fqdn=False):
         """Creates the infrastructure for a Cloudify manager."""
         self._logger.info('Creating image based cloudify instances: '
                           '[number_of_instances=%d]', len(self.instances))
 
-        test_identifier = '{test}_{time}'.format(
+        test_identifier = '{test}_{worker}_{time}_{unique}'.format(
             # Strip out any characters from the test name that might cause
             # systems with restricted naming to become upset
             test=re.sub(
@@ -1157,17 +1624,26 @@ class Hosts(object):
                 # This is set by pytest and looks like:
                 # cosmo_tester/test_suites/some_tests/\
                 # some_test.py::test_specific_thing
-                os.environ['PYTEST_CURRENT_TEST'].split('/')[-1],
+                os.environ.get('PYTEST_CURRENT_TEST', 'session').split(
+                    '/')[-1],
             ),
+            # This is set by pytest-xdist, e.g. gw3
+            worker=os.environ.get('PYTEST_XDIST_WORKER', 'main'),
             time=datetime.strftime(datetime.now(), '%Y%m%d%H%M%S'),
+            # Sessions on other machines may start in the same second
+            unique=uuid.uuid4().hex[:6],
         )
         self.test_identifier = test_identifier
 
         try:
+            if self._use_host_pool():
+                self._create_from_host_pool(use_fqdn)
+                return
+
             self._logger.info('Creating test tenant')
             self._infra_client.tenants.create(test_identifier)
-            self._infra_client._client.headers[
-                CLOUDIFY_TENANT_HEADER] = test_identifier
+            self._infra_client = util.get_tenant_client(self._infra_client,
+                                                        test_identifier)
             self.tenant = test_identifier
 
             self._upload_secrets_to_infrastructure_manager()
@@ -1183,23 +1659,6 @@ class Hosts(object):
                                            instance.is_manager,
                                            instance.image_type)
             self._finish_deploy_test_vms(use_fqdn=use_fqdn)
-
-            for instance in self.instances:
-                if instance.is_manager and not instance.bootstrappable:
-                    # A pre-bootstrapped manager is desired for this test,
-                    # let's make it happen.
-                    instance.bootstrap(
-                        upload_license=self._test_config['premium'],
-                        blocking=False)
-
-            for instance in self.instances:
-                if instance.is_manager and not instance.bootstrappable:
-                    self._logger.info('Waiting for instance %s to bootstrap',
-                                      instance.image_name)
-                    while not instance.bootstrap_is_complete():
-                        time.sleep(3)
-                if instance.should_finalize:
-                    instance.finalize_preparation()
         except Exception as err:
             self._logger.error(
                 "Encountered exception trying to create test resources: %s.\n"
@@ -1208,6 +1667,7 @@ class Hosts(object):
             self.destroy()
             raise
 
+    @timeline.traced
     def destroy(self, passed=None):
         """Destroys the infrastructure. """
         if passed is None:
@@ -1236,6 +1696,9 @@ class Hosts(object):
                 )
                 return
 
+        if self._pool_leases:
+            self._return_to_host_pool()
+
         self._logger.info('Destroying test hosts..')
         if self.tenant:
             self._logger.info('Ensuring executions are stopped.')
@@ -1261,25 +1724,7 @@ class Hosts(object):
                         execution['workflow_id'],
                     )
 
-            cancel_complete = []
-            for execution_id in cancelled:
-                self._logger.info('Checking {} is cancelled.'.format(
-                    execution_id,
-                ))
-                for _ in range(30):
-                    execution = self._infra_client.executions.get(
-                        execution_id)
-                    self._logger.info('{} is in state {}.'.format(
-                        execution_id,
-                        execution['status'],
-                    ))
-                    if execution['status'] == 'cancelled':
-                        cancel_complete.append(execution_id)
-                        break
-                    else:
-                        time.sleep(3)
-
-            cancel_failures = set(cancelled).difference(cancel_complete)
+            cancel_failures = self._wait_for_cancellations(cancelled)
             if cancel_failures:
                 self._logger.error(
                     'Teardown failed due to the following executions not '
@@ -1289,24 +1734,27 @@ class Hosts(object):
                 )
                 raise RuntimeError('Could not complete teardown.')
 
-            self._start_undeploy_test_vms()
-            self._finish_undeploy_test_vms()
+            concurrency = self._test_config['teardown']['concurrency']
+            timings = []
+            timings.extend(self._undeploy_test_vms(concurrency))
 
             self._logger.info('Uninstalling infrastructure')
+            started = time.time()
             util.run_blocking_execution(
                 self._infra_client, 'infrastructure', 'uninstall',
                 self._logger)
-            util.delete_deployment(self._infra_client, 'infrastructure',
-                                   self._logger)
-
-            self._logger.info('Deleting blueprints.')
-            for blueprint in self.blueprints:
-                self._logger.info('Deleting %s', blueprint)
-                self._infra_client.blueprints.delete(blueprint)
+            timings.append(('uninstall infrastructure',
+                            time.time() - started))
+            timings.extend(
+                ('delete deployment ' + deployment_id, duration)
+                for deployment_id, duration in util.delete_deployments(
+                    self._infra_client, ['infrastructure'], self._logger,
+                ).items()
+            )
 
             self._logger.info('Deleting plugins.')
-            plugins = self._infra_client.plugins.list()
-            for plugin in plugins:
+            plugins = []
+            for plugin in self._infra_client.plugins.list():
                 if plugin["tenant_name"] != self.tenant:
                     self._logger.info(
                         'Skipping shared %s (%s)',
@@ -1314,27 +1762,249 @@ class Hosts(object):
                         plugin['id'],
                     )
                 else:
-                    self._logger.info(
-                        'Deleting %s (%s)',
-                        plugin['package_name'],
-                        plugin['id'],
-                    )
-                    self._infra_client.plugins.delete(plugin['id'])
+                    plugins.append(plugin)
+            timings.extend(util.parallel_map(
+                self._delete_plugin, plugins, max_workers=concurrency,
+            ))
+
+            self._logger.info('Teardown timings:')
+            for resource, duration in timings:
+                self._logger.info('  %s: %.1fs', resource, duration)
 
             self._logger.info('Deleting tenant %s', self.tenant)
-            self._infra_client._client.headers[
-                CLOUDIFY_TENANT_HEADER] = 'default_tenant'
+            self._infra_client = util.get_tenant_client(self._infra_client,
+                                                        'default_tenant')
             self._infra_client.tenants.delete(self.tenant)
             self.tenant = None
 
+    @timeline.traced
     def rsync_backup(self):
         for instance in self.instances:
             instance.rsync_backup()
             self._logger.info('Waiting for instance %s to Rsync backup',
                               instance.image_name)
-        for instance in self.instances:
-            while not instance.async_command_is_complete('Rsync backup'):
-                time.sleep(3)
+        util.wait_for_async_commands(
+            (instance, 'Rsync backup') for instance in self.instances)
+
+    def _use_host_pool(self):
+        if not self._test_config['host_pool']['enabled']:
+            return False
+        # Pooled VMs are reset using rsync, and only use the default network
+        return not (
+            self.multi_net
+            or self.ipv6_net
+            or any(instance.windows for instance in self.instances)
+        )
+
+    def _create_from_host_pool(self, use_fqdn):
+        """Lease VMs from the host pool, creating any that it is short of.
+        """
+        pool_tenant = self._test_config['host_pool']['tenant']
+        self._logger.info('Leasing test hosts from pool tenant %s',
+                          pool_tenant)
+        # Other workers in this run may be setting up the pool too
+        with util.file_lock(self._get_host_pool_lock_path()):
+            self._ensure_host_pool_infrastructure(pool_tenant)
+        self._reclaim_stale_leases()
+
+        available = [
+            inst['deployment_id']
+            for inst in self._infra_client.node_instances.list(
+                node_id='test_host',
+                _include=['deployment_id', 'state'],
+                _get_all_results=True,
+            )
+            if inst['deployment_id'].startswith(POOL_DEPLOYMENT_PREFIX)
+            and inst['state'] == 'started'
+        ]
+        # Avoid every session contending for the same VMs
+        random.shuffle(available)
+
+        created = set()
+        for index, instance in enumerate(self.instances):
+            prefix = '{}{}_'.format(POOL_DEPLOYMENT_PREFIX,
+                                    self._get_pool_key(instance))
+            vm_id = None
+            for candidate in available:
+                if candidate.startswith(prefix) and self._lease(candidate):
+                    available.remove(candidate)
+                    vm_id = candidate
+                    break
+            if vm_id is None:
+                vm_id = prefix + uuid.uuid4().hex[:8]
+                self._lease(vm_id)
+                self._start_deploy_test_vm(
+                    instance.image_name, index, pool_tenant,
+                    instance.is_manager, instance.image_type, vm_id=vm_id,
+                )
+                created.add(vm_id)
+            self._logger.info('Leased %s for instance %d', vm_id, index)
+            self._pool_leases[index] = vm_id
+
+        util.parallel_map(
+            lambda lease: self._prepare_pool_vm(
+                *lease, use_fqdn=use_fqdn, created=lease[1] in created),
+            list(self._pool_leases.items()),
+        )
+
+    def _get_host_pool_lock_path(self):
+        return '{}.lock'.format(os.path.expanduser(
+            self._test_config['host_pool']['ssh_key_path']))
+
+    def _ensure_host_pool_infrastructure(self, pool_tenant):
+        self._upload_blueprints_to_infrastructure_manager()
+        tenants = [
+            tenant['name']
+            for tenant in self._infra_client.tenants.list(_include=['name'])
+        ]
+        if pool_tenant not in tenants:
+            self._logger.info('Creating host pool tenant')
+            self._infra_client.tenants.create(pool_tenant)
+            self._infra_client = util.get_tenant_client(self._infra_client,
+                                                        pool_tenant)
+            self._upload_secrets_to_infrastructure_manager()
+            self._upload_plugins_to_infrastructure_manager()
+            self._deploy_test_infrastructure(pool_tenant)
+            return
+
+        self._infra_client = util.get_tenant_client(self._infra_client,
+                                                    pool_tenant)
+        if not self._infra_client.deployments.list(id='infrastructure',
+                                                   _include=['id']):
+            raise RuntimeError(
+                'Host pool tenant {} has no infrastructure deployment. '
+                'Please delete the tenant so that it can be recreated.'
+                .format(pool_tenant)
+            )
+        if self._test_config['target_platform'] == 'aws':
+            self._populate_aws_platform_properties()
+
+    def _get_pool_key(self, instance):
+        """Get a key identifying VMs which can be leased for this instance."""
+        return hashlib.sha1(json.dumps([
+            instance.image_name,
+            instance.image_type,
+            instance.is_manager,
+            instance.userdata,
+            self.server_flavor,
+            # The blueprint IDs are based on their content
+            self._blueprint_ids['test_vm'],
+            self._test_config.platform,
+        ], sort_keys=True, default=str).encode('utf-8')).hexdigest()[:10]
+
+    def _lease(self, vm_id, prefix=POOL_LEASE_SECRET_PREFIX):
+        try:
+            self._infra_client.secrets.create(
+                prefix + vm_id, json.dumps({
+                    'session': self.test_identifier,
+                    'leased_at': time.time(),
+                }),
+            )
+        except CloudifyClientError as err:
+            if err.status_code == 409:
+                # Somebody else has it
+                return False
+            raise
+        return True
+
+    def _reclaim_stale_leases(self):
+        """Remove pooled VMs whose leases are older than the lease timeout,
+        as the sessions which leased them must have died without returning
+        them, leaving them in an unknown state.
+        """
+        lease_timeout = self._test_config['host_pool']['lease_timeout']
+        for secret in self._infra_client.secrets.list(
+            _include=['key'], _get_all_results=True,
+        ):
+            if not secret['key'].startswith(POOL_LEASE_SECRET_PREFIX):
+                continue
+            vm_id = secret['key'][len(POOL_LEASE_SECRET_PREFIX):]
+            leased_at = self._get_lease_time(vm_id)
+            if leased_at is None or time.time() - leased_at < lease_timeout:
+                continue
+            # Only one session may remove it
+            if not self._lease(vm_id, prefix=POOL_RECLAIM_SECRET_PREFIX):
+                continue
+            try:
+                # It may have been returned and leased again meanwhile
+                if self._get_lease_time(vm_id) != leased_at:
+                    continue
+                self._logger.warning(
+                    'Lease of %s has expired, removing it from the pool',
+                    vm_id)
+                self._remove_pool_vm(vm_id)
+                self._infra_client.secrets.delete(secret['key'])
+            finally:
+                self._infra_client.secrets.delete(
+                    POOL_RECLAIM_SECRET_PREFIX + vm_id)
+
+    def _get_lease_time(self, vm_id):
+        """Get when a pooled VM was leased, or None if it isn't leased."""
+        try:
+            lease = self._infra_client.secrets.get(
+                POOL_LEASE_SECRET_PREFIX + vm_id)
+        except CloudifyClientError as err:
+            if err.status_code == 404:
+                return None
+            raise
+        try:
+            return json.loads(lease.value)['leased_at']
+        except (ValueError, TypeError, KeyError):
+            # Leases from before they were timestamped
+            return 0
+
+    def _prepare_pool_vm(self, index, vm_id, use_fqdn, created):
+        if created:
+            execution, _ = self._test_vm_installs[vm_id]
+            util.wait_for_execution(self._infra_client, execution,
+                                    self._logger)
+
+        node_instance = util.get_node_instance_cache(
+            self._infra_client).get('test_host', vm_id)[0]
+        self._update_instance(index, node_instance, use_fqdn=use_fqdn)
+        instance = self.instances[index]
+        if created:
+            instance.rsync_backup(backup_dir=POOL_BACKUP_DIR)
+            instance.wait_for_async_command('Rsync backup')
+        self._prepare_instance(instance)
+
+    @timeline.traced
+    def _return_to_host_pool(self):
+        self._logger.info('Returning test hosts to the pool.')
+        util.parallel_map(lambda lease: self._return_pool_vm(*lease),
+                          list(self._pool_leases.items()))
+        self._pool_leases = {}
+
+    def _return_pool_vm(self, index, vm_id):
+        instance = self.instances[index]
+        try:
+            util.rsync_restore([instance], backup_dir=POOL_BACKUP_DIR)
+            util.reboot_if_required([instance])
+            # Don't leave this test's backup to be mixed with the next one's
+            instance.run_command(
+                'rm -rf {} {}'.format(RSYNC_BACKUP_DIR,
+                                      RSYNC_CHECKPOINT_DIR),
+                use_sudo=True,
+            )
+        except Exception as err:
+            self._logger.warning(
+                'Could not restore %s, removing it from the pool: %s',
+                vm_id, err,
+            )
+            self._remove_pool_vm(vm_id)
+        finally:
+            self._infra_client.secrets.delete(
+                POOL_LEASE_SECRET_PREFIX + vm_id)
+
+    def _remove_pool_vm(self, vm_id):
+        if not self._infra_client.deployments.list(id=vm_id,
+                                                   _include=['id']):
+            return
+        util.run_blocking_execution(
+            self._infra_client, vm_id, 'uninstall', self._logger,
+            params={'ignore_failure': True},
+        )
+        util.delete_deployment(self._infra_client, vm_id, self._logger)
 
     def _upload_secrets_to_infrastructure_manager(self):
         self._logger.info(
@@ -1383,20 +2053,15 @@ class Hosts(object):
             suffix = '{}-ipv6'.format(suffix)
         if self.multi_net:
             suffix = '{}-multi-net'.format(suffix)
-        self._infra_client.blueprints.upload(
-            util.get_resource_path(
+        blueprints = {
+            'infrastructure': util.get_resource_path(
                 'infrastructure_blueprints/{}/infrastructure{}.yaml'.format(
                     self._test_config['target_platform'],
                     suffix,
                 )
             ),
-            "infrastructure",
-            async_upload=True,
-            legacy=self._infra_mgr_version < 7,
-        )
-        util.wait_for_blueprint_upload(self._infra_client, "infrastructure")
+        }
 
-        self.blueprints.append('infrastructure')
         test_vm_suffixes = ['']
         if self.ipv6_net:
             test_vm_suffixes.append('-ipv6')
@@ -1404,21 +2069,19 @@ class Hosts(object):
             test_vm_suffixes.append('-multi-net')
 
         for suffix in test_vm_suffixes:
-            blueprint_id = "test_vm{}".format(suffix)
-            self._infra_client.blueprints.upload(
-                util.get_resource_path(
-                    'infrastructure_blueprints/{}/vm{}.yaml'.format(
-                        self._test_config['target_platform'],
-                        suffix,
-                    )
-                ),
-                blueprint_id,
-                async_upload=True,
-                legacy=self._infra_mgr_version < 7,
+            blueprints['test_vm{}'.format(suffix)] = util.get_resource_path(
+                'infrastructure_blueprints/{}/vm{}.yaml'.format(
+                    self._test_config['target_platform'],
+                    suffix,
+                )
             )
-            util.wait_for_blueprint_upload(self._infra_client, blueprint_id)
-            self.blueprints.append('test_vm{}'.format(suffix))
 
+        self._blueprint_ids = util.upload_shared_blueprints(
+            self._infra_client, blueprints, self._logger,
+            legacy=self._infra_mgr_version < 7,
+        )
+
+    @timeline.traced
     def _deploy_test_infrastructure(self, test_identifier):
         self._logger.info('Creating test infrastructure inputs.')
         infrastructure_inputs = {'test_infrastructure_name': test_identifier}
@@ -1439,7 +2102,8 @@ class Hosts(object):
             'Creating test infrastructure using infrastructure manager.'
         )
         util.create_deployment(
-            self._infra_client, 'infrastructure', 'infrastructure',
+            self._infra_client, self._blueprint_ids['infrastructure'],
+            'infrastructure',
             self._logger, inputs=infrastructure_inputs,
         )
         self.deployments.append('infrastructure')
@@ -1468,14 +2132,14 @@ class Hosts(object):
             self._populate_aws_platform_properties()
 
     def _start_deploy_test_vm(self, image_id, index, test_identifier,
-                              is_manager, image_type):
+                              is_manager, image_type, vm_id=None):
         self._logger.info(
             'Preparing to deploy instance %d of image %s',
             index,
             image_id,
         )
 
-        vm_id = 'vm_{}_{}'.format(
+        vm_id = vm_id or 'vm_{}_{}'.format(
             image_id
             .replace(' ', '_')
             .replace('(', '_')
@@ -1535,7 +2199,8 @@ class Hosts(object):
 
         self._logger.info('Deploying instance %d of %s', index, image_id)
         util.create_deployment(
-            self._infra_client, blueprint_id, vm_id, self._logger,
+            self._infra_client, self._blueprint_ids[blueprint_id], vm_id,
+            self._logger,
             inputs=vm_inputs,
         )
         self.deployments.append(vm_id)
@@ -1549,73 +2214,157 @@ class Hosts(object):
     def _populate_aws_platform_properties(self):
         self._logger.info('Retrieving AWS resource IDs')
         resource_ids = {}
+        node_instances = util.get_node_instance_cache(self._infra_client)
 
-        subnet = util.get_node_instances(
-            'test_subnet_1', 'infrastructure', self._infra_client)[0]
+        subnet = node_instances.get('test_subnet_1', 'infrastructure')[0]
         resource_ids['subnet_id'] = subnet['runtime_properties'][
             'aws_resource_id']
         if self.multi_net:
-            subnet_2 = util.get_node_instances(
-                'test_subnet_2', 'infrastructure', self._infra_client)[0]
+            subnet_2 = node_instances.get('test_subnet_2', 'infrastructure')[0]
             resource_ids['subnet_2_id'] = subnet_2['runtime_properties'][
                 'aws_resource_id']
-            subnet_3 = util.get_node_instances(
-                'test_subnet_3', 'infrastructure', self._infra_client)[0]
+            subnet_3 = node_instances.get('test_subnet_3', 'infrastructure')[0]
             resource_ids['subnet_3_id'] = subnet_3['runtime_properties'][
                 'aws_resource_id']
 
-        vpc = util.get_node_instances(
-            'vpc', 'infrastructure', self._infra_client)[0]
+        vpc = node_instances.get('vpc', 'infrastructure')[0]
         resource_ids['vpc_id'] = vpc['runtime_properties']['aws_resource_id']
-        security_group = util.get_node_instances(
-            'security_group', 'infrastructure', self._infra_client)[0]
+        security_group = node_instances.get(
+            'security_group', 'infrastructure')[0]
         resource_ids['security_group_id'] = security_group[
             'runtime_properties']['aws_resource_id']
 
         self._platform_resource_ids = resource_ids
 
+    @timeline.traced
     def _finish_deploy_test_vms(self, use_fqdn=False):
+        """Wait for the test VMs to deploy, preparing each one as it comes up.
+
+        Each VM is assigned, checked for SSH and bootstrapped (if required) on
+        a worker as soon as its own install has finished, so that we don't
+        wait for the slowest VM before bootstrapping the others.
+        """
+        # With IPv6 we have to know every VM's address before IPv4 can be
+        # disabled on any of them, so that has to happen before preparation.
+        prepare = not self.ipv6_net
         node_instances = {}
-        for vm_id, details in self._test_vm_installs.items():
-            execution, index = details
+        with ThreadPoolExecutor(
+            max_workers=max(len(self._test_vm_installs), 1),
+        ) as pool:
+            futures = [
+                pool.submit(self._finish_deploy_test_vm, vm_id, execution,
+                            index, use_fqdn, prepare)
+                for vm_id, (execution, index)
+                in self._test_vm_installs.items()
+            ]
+            for index, node_instance in util.results_as_completed(futures):
+                node_instances[index] = node_instance
+
+        if self.ipv6_net:
+            self._disable_ipv4(node_instances)
+            with ThreadPoolExecutor(max_workers=len(node_instances)) as pool:
+                futures = [
+                    pool.submit(self._prepare_instance, self.instances[index])
+                    for index in node_instances
+                ]
+                list(util.results_as_completed(futures))
+
+    def _finish_deploy_test_vm(self, vm_id, execution, index, use_fqdn,
+                               prepare):
+        with timeline.span('VM install', vm_id):
             util.wait_for_execution(self._infra_client, execution,
                                     self._logger)
 
-            self._logger.info('Retrieving deployed instance details.')
-            node_instance = util.get_node_instances('test_host', vm_id,
-                                                    self._infra_client)[0]
+        self._logger.info('Retrieving deployed instance details for %s.',
+                          vm_id)
+        node_instance = util.get_node_instance_cache(
+            self._infra_client).get('test_host', vm_id)[0]
 
-            self._logger.info('Storing instance details.')
-            self._update_instance(
-                index,
-                node_instance,
-                use_fqdn=use_fqdn,
-            )
+        self._logger.info('Storing instance details for %s.', vm_id)
+        self._update_instance(
+            index,
+            node_instance,
+            use_fqdn=use_fqdn,
+        )
 
-            node_instances[index] = node_instance
+        if prepare:
+            self._prepare_instance(self.instances[index])
 
-        if self.ipv6_net:
-            self._disable_ipv4(node_instances)
+        return index, node_instance
 
-    def _start_undeploy_test_vms(self):
+    def _prepare_instance(self, instance):
+        with timeline.span('Hosts._prepare_instance',
+                           instance.deployment_id):
+            instance.wait_for_ssh()
+            if instance.is_manager and not instance.bootstrappable:
+                # A pre-bootstrapped manager is desired for this test,
+                # let's make it happen.
+                instance.bootstrap(
+                    upload_license=self._test_config['premium'],
+                    blocking=False)
+                self._logger.info('Waiting for instance %s to bootstrap',
+                                  instance.image_name)
+                instance.wait_for_bootstrap()
+            if instance.should_finalize:
+                instance.finalize_preparation()
+
+    def _wait_for_cancellations(self, execution_ids):
+        """Wait for cancelled executions, returning any which didn't cancel.
+        """
+        waiting = set(execution_ids)
+        for _ in range(30):
+            if not waiting:
+                break
+            for execution in self._infra_client.executions.list(
+                id=list(waiting),
+                _include=['id', 'status'],
+                _get_all_results=True,
+            ):
+                self._logger.info('{} is in state {}.'.format(
+                    execution['id'],
+                    execution['status'],
+                ))
+                if execution['status'] == 'cancelled':
+                    waiting.discard(execution['id'])
+            if waiting:
+                time.sleep(3)
+        return waiting
+
+    def _undeploy_test_vms(self, concurrency):
+        """Uninstall and delete the test VM deployments, returning timings.
+        """
         # Operate on all deployments except the infrastructure one
-        for vm_id in self.deployments[1:]:
-            self._logger.info('Uninstalling %s', vm_id)
-            self._test_vm_uninstalls[vm_id] = (
-                self._infra_client.executions.start(
-                    vm_id, 'uninstall',
-                )
-            )
+        vm_ids = self.deployments[1:]
+        timings = util.parallel_map(self._undeploy_test_vm, vm_ids,
+                                    max_workers=concurrency)
+        # Delete only after all of the uninstalls to cope with large
+        # deployment counts and small mgmtworker worker counts
+        deletions = util.delete_deployments(
+            self._infra_client, vm_ids, self._logger,
+            concurrency=concurrency,
+        )
+        timings.extend(
+            ('delete deployment ' + vm_id, duration)
+            for vm_id, duration in deletions.items()
+        )
+        return timings
 
-    def _finish_undeploy_test_vms(self):
-        for vm_id, execution in self._test_vm_uninstalls.items():
-            util.wait_for_execution(self._infra_client, execution,
-                                    self._logger)
-        # Do this separately to cope with large deployment counts and small
-        # mgmtworker worker counts
-        for vm_id, execution in self._test_vm_uninstalls.items():
-            util.delete_deployment(self._infra_client, vm_id,
-                                   self._logger)
+    def _undeploy_test_vm(self, vm_id):
+        self._logger.info('Uninstalling %s', vm_id)
+        started = time.time()
+        execution = self._infra_client.executions.start(vm_id, 'uninstall')
+        util.wait_for_execution(self._infra_client, execution, self._logger)
+        return 'uninstall ' + vm_id, time.time() - started
+
+    def _delete_plugin(self, plugin):
+        self._logger.info(
+            'Deleting %s (%s)',
+            plugin['package_name'],
+            plugin['id'],
+        )
+        started = time.time()
+        self._infra_client.plugins.delete(plugin['id'])
+        return 'delete plugin ' + plugin['package_name'], time.time() - started
 
     def _update_instance(self, server_index, node_instance, use_fqdn=False):
         instance = self.instances[server_index]
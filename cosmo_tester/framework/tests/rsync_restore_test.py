@@ -0,0 +1,73 @@
+from cosmo_tester.framework.test_hosts import parse_rsync_restore_log
+
+# Trimmed output of rsync -aAHX --itemize-changes --stats
+LOG_TEMPLATE = """{items}
+
+Number of files: 123,456 (reg: 100,000, dir: 23,000, link: 456)
+Number of created files: 2 (reg: 2)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 3
+Total file size: 4,567,890,123 bytes
+Total transferred file size: 12,345 bytes
+Literal data: 12,345 bytes
+Matched data: 0 bytes
+"""
+
+
+def _parse(*items):
+    return parse_rsync_restore_log(LOG_TEMPLATE.format(
+        items='\n'.join(items)))
+
+
+def test_changes_are_parsed():
+    result = _parse(
+        '*deleting   var/log/cloudify/test.log',
+        '>f.st...... etc/hosts',
+        'cL+++++++++ etc/alternatives/python -> /usr/bin/python3',
+        'cd+++++++++ var/tmp/new/',
+        'hf+++++++++ usr/bin/copy => usr/bin/original',
+    )
+
+    assert result.changed_paths == [
+        'var/log/cloudify/test.log',
+        'etc/hosts',
+        'etc/alternatives/python -> /usr/bin/python3',
+        'var/tmp/new/',
+        'usr/bin/copy => usr/bin/original',
+    ]
+    assert result.transferred_bytes == 12345
+
+
+def test_attribute_changes_are_ignored():
+    result = _parse(
+        '.d..t...... etc/',
+        '.f...p..... etc/passwd',
+    )
+
+    assert result.changed_paths == []
+    assert not result.reboot_required
+
+
+def test_nothing_changed():
+    result = _parse()
+
+    assert result.changed_paths == []
+    assert not result.reboot_required
+
+
+def test_log_changes_do_not_require_reboot():
+    result = _parse(
+        '>f.st...... var/log/messages',
+        '*deleting   var/tmp/leftover',
+        '>f+++++++++ var/lib/systemd/timers/stamp-dnf-makecache.timer',
+    )
+
+    assert not result.reboot_required
+
+
+def test_other_changes_require_reboot():
+    for item in ['>f.st...... etc/hosts',
+                 '*deleting   opt/manager/resources/blueprint.yaml',
+                 'cL+++++++++ usr/lib/systemd/system/test.service -> x',
+                 '>f.st...... var/lib/pgsql/data/base/1']:
+        assert _parse(item).reboot_required, item
@@ -0,0 +1,443 @@
+from concurrent.futures import CancelledError, Future
+import gc
+import logging
+import weakref
+
+import pytest
+
+from cosmo_tester.framework import util
+from cosmo_tester.framework.constants import CLOUDIFY_TENANT_HEADER
+
+
+class FakeExecution(dict):
+    END_STATES = ['terminated', 'failed', 'cancelled']
+    TERMINATED = 'terminated'
+
+    @property
+    def status(self):
+        return self['status']
+
+
+class FakeManager(object):
+    def __init__(self):
+        self.statuses = {}
+        # The deployment and workflow of each execution, by ID
+        self.workflows = {}
+        # The status which new executions of each workflow end in
+        self.workflow_statuses = {}
+        self.deployments = []
+        self.events = {}
+        self.node_instances = {}
+        self.listed_tenants = []
+        self.listed_deployments = []
+
+
+class FakeExecutions(object):
+    def __init__(self, manager, tenant):
+        self._manager = manager
+        self._tenant = tenant
+
+    def list(self, id=None, workflow_id=None, _include=None,
+             _get_all_results=False):
+        self._manager.listed_tenants.append(self._tenant)
+        executions = [
+            self._get(execution_id) for execution_id in self._manager.statuses
+        ]
+        return [
+            execution for execution in executions
+            if (id is None or execution['id'] in id)
+            and workflow_id in (None, execution['workflow_id'])
+        ]
+
+    def start(self, deployment_id, workflow_id):
+        execution_id = '{}_{}'.format(workflow_id, deployment_id)
+        self._manager.workflows[execution_id] = (deployment_id, workflow_id)
+        self._manager.statuses[execution_id] = (
+            self._manager.workflow_statuses.get(workflow_id, 'terminated'))
+        return self._get(execution_id)
+
+    def _get(self, execution_id):
+        deployment_id, workflow_id = self._manager.workflows.get(
+            execution_id, ('dep', None))
+        return FakeExecution(id=execution_id,
+                             status=self._manager.statuses[execution_id],
+                             deployment_id=deployment_id,
+                             workflow_id=workflow_id)
+
+
+class FakeDeployments(object):
+    def __init__(self, manager, executions):
+        self._manager = manager
+        self._executions = executions
+
+    def create(self, blueprint_id, deployment_id):
+        self._manager.deployments.append((blueprint_id, deployment_id))
+        self._executions.start(deployment_id, 'create_deployment_environment')
+
+
+class FakeBlueprints(object):
+    def get(self, blueprint_id):
+        return {'id': blueprint_id, 'state': 'uploaded'}
+
+
+class FakeEvents(object):
+    def __init__(self, manager):
+        self._manager = manager
+        self._requests = 0
+
+    def list(self, execution_id, include_logs, sort, _offset, _size):
+        events = self._manager.events.get(execution_id, [])
+        # Entries which share a timestamp come back in any order, e.g.
+        # reversed on every other request
+        self._requests += 1
+        if self._requests % 2:
+            events = events[::-1]
+        events = sorted(events, key=lambda event: event[sort])
+        return events[_offset:_offset + _size]
+
+
+class FakeNodeInstances(object):
+    def __init__(self, manager, headers):
+        self._manager = manager
+        self._headers = headers
+
+    def list(self, deployment_id, _include):
+        key = (self._headers[CLOUDIFY_TENANT_HEADER], deployment_id)
+        self._manager.listed_deployments.append(key)
+        return list(self._manager.node_instances.get(key, []))
+
+
+class FakeClient(object):
+    def __init__(self, manager, tenant='default_tenant'):
+        self._client = FakeHTTPClient({CLOUDIFY_TENANT_HEADER: tenant})
+        self.executions = FakeExecutions(manager, tenant)
+        self.deployments = FakeDeployments(manager, self.executions)
+        self.blueprints = FakeBlueprints()
+        self.events = FakeEvents(manager)
+        self.node_instances = FakeNodeInstances(manager,
+                                                self._client.headers)
+
+
+class FakeHTTPClient(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = FakeManager()
+    monkeypatch.setattr(
+        util, 'get_tenant_client',
+        lambda client, tenant: FakeClient(manager, tenant),
+    )
+    return manager
+
+
+@pytest.fixture
+def client(manager):
+    return FakeClient(manager)
+
+
+@pytest.fixture
+def waiter(client):
+    return util.ExecutionWaiter(client, poll_interval=0.01)
+
+
+def _event(message, timestamp=0):
+    return {'type': 'cloudify_event', 'message': message,
+            'timestamp': timestamp}
+
+
+def _node_instance(node_id):
+    return {'id': node_id + '_1', 'node_id': node_id}
+
+
+def _ids(node_instances):
+    return [node_instance['id'] for node_instance in node_instances]
+
+
+def test_results_as_completed_cancels_pending_on_error():
+    failed = Future()
+    failed.set_exception(ValueError('failed'))
+    pending = Future()
+
+    with pytest.raises(ValueError):
+        list(util.results_as_completed([failed, pending]))
+    assert pending.cancelled()
+
+
+def test_results_as_completed_yields_results():
+    futures = [Future() for _ in range(3)]
+    for number, future in enumerate(futures):
+        future.set_result(number)
+
+    assert sorted(util.results_as_completed(futures)) == [0, 1, 2]
+
+
+def test_waiters_of_one_execution_get_their_own_futures(manager, waiter):
+    manager.statuses['exc'] = 'started'
+    logger = logging.getLogger('test')
+
+    first = waiter.watch({'id': 'exc'}, logger)
+    second = waiter.watch({'id': 'exc'}, logger)
+    assert first is not second
+
+    # A caller giving up (e.g. in results_as_completed) affects nobody else
+    first.cancel()
+    manager.statuses['exc'] = 'terminated'
+    assert second.result(timeout=5).status == 'terminated'
+    with pytest.raises(CancelledError):
+        first.result()
+
+
+def test_waiter_timeouts_are_per_caller(manager, waiter):
+    manager.statuses['exc'] = 'started'
+    logger = logging.getLogger('test')
+
+    impatient = waiter.watch({'id': 'exc'}, logger, timeout=0)
+    patient = waiter.watch({'id': 'exc'}, logger, timeout=60)
+
+    with pytest.raises(util.ExecutionTimeout):
+        impatient.result(timeout=5)
+    assert not patient.done()
+
+    manager.statuses['exc'] = 'terminated'
+    assert patient.result(timeout=5).status == 'terminated'
+
+
+def test_waiter_fails_failed_executions(manager, waiter):
+    manager.statuses['exc'] = 'failed'
+
+    future = waiter.watch({'id': 'exc'}, logging.getLogger('test'))
+    with pytest.raises(util.ExecutionFailed):
+        future.result(timeout=5)
+
+
+def test_waiter_polls_the_tenant_used_when_watching(manager):
+    manager.statuses['exc'] = 'started'
+    client = FakeClient(manager, tenant='first')
+    waiter = util.ExecutionWaiter(client, poll_interval=0.01)
+
+    future = waiter.watch({'id': 'exc'}, logging.getLogger('test'))
+    # e.g. set_client_tenant in the test thread
+    client._client.headers[CLOUDIFY_TENANT_HEADER] = 'second'
+    manager.statuses['exc'] = 'terminated'
+    future.result(timeout=5)
+
+    assert set(manager.listed_tenants) == {'first'}
+
+
+def test_waiter_does_not_keep_its_client_alive(manager):
+    client = FakeClient(manager)
+    util.get_execution_waiter(client)
+    util.get_node_instance_cache(client)
+    client_ref = weakref.ref(client)
+
+    del client
+    gc.collect()
+    assert client_ref() is None
+
+
+def test_node_instance_cache_lists_each_deployment_once(manager, client):
+    manager.node_instances[('default_tenant', 'dep')] = [
+        _node_instance('vm'), _node_instance('app')]
+    cache = util.NodeInstanceCache(client)
+
+    assert _ids(cache.get('vm', 'dep')) == ['vm_1']
+    assert _ids(cache.get('app', 'dep')) == ['app_1']
+    assert cache.get('missing', 'dep') == []
+    assert manager.listed_deployments == [('default_tenant', 'dep')]
+
+
+def test_node_instance_cache_is_per_tenant(manager, client):
+    manager.node_instances[('default_tenant', 'dep')] = [_node_instance('vm')]
+    manager.node_instances[('other', 'dep')] = [_node_instance('app')]
+    cache = util.NodeInstanceCache(client)
+
+    assert _ids(cache.get('vm', 'dep')) == ['vm_1']
+    with util.set_client_tenant(client, 'other'):
+        assert _ids(cache.get('vm', 'dep')) == []
+        assert _ids(cache.get('app', 'dep')) == ['app_1']
+
+
+def test_node_instance_cache_lists_again_when_invalidated(manager, client):
+    manager.node_instances[('default_tenant', 'dep')] = [_node_instance('vm')]
+    cache = util.NodeInstanceCache(client)
+    cache.get('vm', 'dep')
+
+    manager.node_instances[('default_tenant', 'dep')].append(
+        _node_instance('app'))
+    cache.invalidate('dep')
+
+    assert _ids(cache.get('app', 'dep')) == ['app_1']
+    assert len(manager.listed_deployments) == 2
+
+
+def test_event_tailer_pages_through_all_events(manager, client):
+    manager.events['exc'] = [_event(str(number), number)
+                             for number in range(5)]
+    tailer = util.EventTailer(client, 'exc')
+    tailer.page_size = 2
+
+    assert [event['message'] for event in tailer.poll()] == [
+        '0', '1', '2', '3', '4']
+
+    manager.events['exc'].append(_event('5', 5))
+    assert [event['message'] for event in tailer.poll()] == ['5']
+
+
+def test_event_tailer_yields_repeated_events(manager):
+    # e.g. an operation retried with the same message in the same second
+    manager.events['exc'] = [_event('Retrying'), _event('Retrying')]
+    tailer = util.EventTailer(FakeClient(manager), 'exc')
+
+    assert len(list(tailer.poll())) == 2
+
+
+def test_event_tailer_yields_tied_events_once(manager, client):
+    manager.events['exc'] = (
+        [_event('a', 1)]
+        + [_event(message, 2) for message in 'bcd']
+        + [_event('e', 3)]
+    )
+    tailer = util.EventTailer(client, 'exc')
+    # So that the events tied at 2 are split across pages
+    tailer.page_size = 2
+
+    messages = [event['message'] for event in tailer.poll()]
+    assert sorted(messages) == ['a', 'b', 'c', 'd', 'e']
+
+    manager.events['exc'].extend([_event('f', 3), _event('g', 4)])
+    assert [event['message'] for event in tailer.poll()] == ['f', 'g']
+
+
+@pytest.fixture
+def seed(monkeypatch, client, waiter):
+    monkeypatch.setattr(util, 'get_execution_waiter', lambda _: waiter)
+    return lambda deployments, **kwargs: util.seed_deployments(
+        client, deployments, logging.getLogger('test'), **kwargs)
+
+
+def test_seed_deployments_creates_and_installs(manager, seed):
+    deployments = [('bp1', 'dep1'), ('bp1', 'dep2'), ('bp2', 'dep3')]
+
+    seed(deployments)
+
+    assert sorted(manager.deployments) == deployments
+    assert sorted(manager.workflows.values()) == [
+        (deployment_id, workflow_id)
+        for _, deployment_id in deployments
+        for workflow_id in ['create_deployment_environment', 'install']
+    ]
+
+
+def test_seed_deployments_can_skip_install(manager, seed):
+    seed([('bp', 'dep1'), ('bp', 'dep2')], install=False)
+
+    assert sorted(manager.workflows.values()) == [
+        ('dep1', 'create_deployment_environment'),
+        ('dep2', 'create_deployment_environment'),
+    ]
+
+
+def test_seed_deployments_fails_on_failed_env_creation(manager, seed):
+    manager.workflow_statuses['create_deployment_environment'] = 'failed'
+
+    with pytest.raises(util.ExecutionFailed):
+        seed([('bp', 'dep1'), ('bp', 'dep2')])
+    assert 'install' not in {
+        workflow_id for _, workflow_id in manager.workflows.values()}
+
+
+class FakeItem(object):
+    def __init__(self, *fixturenames):
+        self.fixturenames = fixturenames
+
+
+class FakeSession(object):
+    def __init__(self, items):
+        self.items = items
+
+
+class FakeRequest(object):
+    def __init__(self, items, current):
+        self.session = FakeSession(items)
+        self.node = items[current]
+
+
+def test_used_by_later_tests_ignores_earlier_tests():
+    items = [FakeItem('manager'), FakeItem('manager'), FakeItem('other')]
+
+    assert util.used_by_later_tests(FakeRequest(items, 0), 'manager')
+    assert not util.used_by_later_tests(FakeRequest(items, 1), 'manager')
+    assert not util.used_by_later_tests(FakeRequest(items, 2), 'other')
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(util, 'time', clock)
+    return clock
+
+
+def test_wait_until_returns_the_result(clock):
+    results = iter([None, [], 'done'])
+
+    result = util.wait_until(lambda: next(results), 60, 'done',
+                             interval=1, jitter=0)
+
+    assert result == 'done'
+    assert clock.sleeps == [1, 2]
+
+
+def test_wait_until_backs_off_until_the_deadline(clock):
+    with pytest.raises(util.WaitTimeout):
+        util.wait_until(lambda: False, 20, 'nothing',
+                        interval=1, max_interval=4, jitter=0)
+
+    assert clock.sleeps == [1, 2, 4, 4, 4, 4, 1]
+    assert clock.now == 1020
+
+
+def test_wait_until_jitters_its_checks(clock, monkeypatch):
+    monkeypatch.setattr(util.random, 'uniform', lambda low, high: high)
+    results = iter([None, None, 'done'])
+
+    util.wait_until(lambda: next(results), 60, 'done', interval=1, jitter=0.5)
+
+    assert clock.sleeps == [1.5, 3]
+
+
+def test_rate_limiter_spaces_out_requests(clock):
+    limiter = util.RateLimiter(max_rate=2)
+
+    for _ in range(3):
+        limiter.wait()
+    clock.now += 10
+    limiter.wait()
+
+    assert clock.sleeps == [0, 0.5, 0.5, 0]
+
+
+def test_wait_until_applies_the_rate_limiter(clock):
+    limiter = util.RateLimiter(max_rate=0.25)
+    results = iter([None, 'done'])
+
+    util.wait_until(lambda: next(results), 60, 'done', interval=1, jitter=0,
+                    rate_limiter=limiter)
+
+    # The check after the first sleep waited out the rest of the 4s gap
+    assert clock.sleeps == [0, 1, 3]
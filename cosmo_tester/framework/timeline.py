@@ -0,0 +1,100 @@
+"""Records how long each phase of test setup takes, on each host.
+
+Spans are kept for the whole session, so that they can be exported as a
+Chrome trace (which can be opened in chrome://tracing or Perfetto) and
+summarised at the end of the run.
+"""
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+
+# Spans which aren't for a specific host
+FRAMEWORK_LANE = 'framework'
+
+_spans = []
+_lock = threading.Lock()
+
+
+def record(name, start, end, host=None):
+    """Record a span which has already finished."""
+    with _lock:
+        _spans.append((name, host or FRAMEWORK_LANE, start, end))
+
+
+@contextmanager
+def span(name, host=None):
+    """Record a span for the duration of this context."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, start, time.time(), host)
+
+
+def traced(func):
+    """Record a span for each call of this function or method.
+    Calls of VM methods are recorded against that VM.
+    """
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        host = getattr(args[0], 'deployment_id', None) if args else None
+        with span(func.__qualname__, host):
+            return func(*args, **kwargs)
+    return wrapped
+
+
+def add_spans(spans, worker):
+    """Add the spans recorded by an xdist worker."""
+    with _lock:
+        for name, host, start, end in spans:
+            if host == FRAMEWORK_LANE:
+                # Each worker's framework spans get their own lane
+                host = '{} ({})'.format(FRAMEWORK_LANE, worker)
+            _spans.append((name, host, start, end))
+
+
+def get_spans():
+    with _lock:
+        return list(_spans)
+
+
+def get_summary():
+    """Get (name, count, total seconds, max seconds) for each kind of span,
+    slowest first.
+    """
+    totals = {}
+    for name, _, start, end in get_spans():
+        count, total, longest = totals.get(name, (0, 0, 0))
+        duration = end - start
+        totals[name] = (count + 1, total + duration, max(longest, duration))
+    return sorted(
+        ((name,) + values for name, values in totals.items()),
+        key=lambda item: item[2],
+        reverse=True,
+    )
+
+
+def export_chrome_trace(path):
+    """Write the spans in the Chrome trace event format."""
+    pid = os.getpid()
+    lanes = {}
+    events = []
+    for name, host, start, end in get_spans():
+        if host not in lanes:
+            lanes[host] = len(lanes) + 1
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                'tid': lanes[host], 'args': {'name': host},
+            })
+        events.append({
+            'name': name, 'cat': 'setup', 'ph': 'X', 'pid': pid,
+            'tid': lanes[host],
+            # Microseconds
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+        })
+    with open(path, 'w') as trace_handle:
+        json.dump({'traceEvents': events}, trace_handle)
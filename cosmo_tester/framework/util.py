@@ -1,18 +1,25 @@
+from collections import Counter
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime, timedelta
 from string import ascii_lowercase, ascii_uppercase, digits
 import errno
+import fcntl
+import functools
 import glob
+import hashlib
 import logging
 import os
 import random
 import requests
+from requests.adapters import HTTPAdapter
 import retrying
 import shlex
 import socket
 import subprocess
 import sys
+import threading
 import time
+import weakref
 
 from cloudify_rest_client import CloudifyClient
 from cloudify_rest_client.exceptions import (
@@ -22,14 +29,26 @@ from cloudify_rest_client.exceptions import (
 from cloudify.cluster_status import ServiceStatus
 
 from cosmo_tester import resources
-from cosmo_tester.framework.constants import CLOUDIFY_TENANT_HEADER
+from cosmo_tester.framework import timeline
+from cosmo_tester.framework.constants import (
+    ASYNC_COMMAND_TIMEOUT,
+    CLOUDIFY_TENANT_HEADER,
+    RSYNC_BACKUP_DIR,
+)
 from cosmo_tester.framework.exceptions import ProcessExecutionError
 
 
+# Connections kept open to each manager, so that several threads can make
+# requests at once
+REST_POOL_SIZE = 32
+# The most checks per second that wait_until will make against one manager
+WAIT_MAX_REQUEST_RATE = 5
+
+
 class SSHKey(object):
-    def __init__(self, tmpdir, logger):
-        self.private_key_path = tmpdir / 'ssh_key.pem'
-        self.public_key_path = tmpdir / 'ssh_key.pem.pub'
+    def __init__(self, tmpdir, logger, private_key_path=None):
+        self.private_key_path = private_key_path or tmpdir / 'ssh_key.pem'
+        self.public_key_path = '{}.pub'.format(self.private_key_path)
         self.logger = logger
         self.tmpdir = tmpdir
 
@@ -52,6 +71,98 @@ def pass_stderr(line, input_queue, process):
     sys.stderr.write(output)
 
 
+def results_as_completed(futures):
+    """Yield the results of futures as they complete.
+    If any of them fails then those which have not started yet are cancelled
+    and the error is raised.
+    """
+    for future in as_completed(futures):
+        try:
+            yield future.result()
+        except Exception:
+            for other in futures:
+                other.cancel()
+            raise
+
+
+def parallel_map(func, items, max_workers=None):
+    """Call func on each item in parallel, returning the results in order."""
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers or len(items)) as pool:
+        futures = [pool.submit(func, item) for item in items]
+        for _ in results_as_completed(futures):
+            pass
+    return [future.result() for future in futures]
+
+
+class WaitTimeout(Exception):
+    """A condition was not met before the deadline."""
+
+
+class RateLimiter(object):
+    """Spaces out requests, e.g. to one manager, across all threads."""
+
+    def __init__(self, max_rate):
+        self._min_gap = 1.0 / max_rate
+        self._next_allowed = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Wait until another request is allowed."""
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_allowed)
+            self._next_allowed = start + self._min_gap
+        time.sleep(start - now)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rest_rate_limiter(client):
+    """Get the rate limiter shared by waits on this client's manager."""
+    host = client._client.host
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(WAIT_MAX_REQUEST_RATE)
+        return _rate_limiters[host]
+
+
+def wait_until(condition, timeout, description, logger=None,
+               interval=0.5, max_interval=10, jitter=0.2, rate_limiter=None):
+    """Wait until condition() returns something true, and return that.
+
+    The time between checks doubles after each one, from `interval` up to
+    `max_interval` seconds, and is varied randomly by up to `jitter` of
+    itself so that many waiters don't check in step.
+
+    :param description: What is being waited for, for logs and errors.
+    :param rate_limiter: A RateLimiter to apply to each check, e.g. from
+                         get_rest_rate_limiter when the check uses the API.
+    :raises WaitTimeout: If the condition isn't met within `timeout` seconds.
+    """
+    deadline = time.time() + timeout
+    delay = interval
+    while True:
+        if rate_limiter:
+            rate_limiter.wait()
+        result = condition()
+        if result:
+            return result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise WaitTimeout('Timed out after {}s waiting for {}'.format(
+                timeout, description))
+        if logger:
+            logger.info('Waiting for %s', description)
+        time.sleep(min(
+            delay * random.uniform(1 - jitter, 1 + jitter), remaining))
+        delay = min(delay * 2, max_interval)
+
+
 def get_resource_path(resource, resources_dir=None):
     resources_dir = resources_dir or os.path.dirname(resources.__file__)
     return os.path.join(resources_dir, resource)
@@ -79,6 +190,40 @@ def create_rest_client(
         **kwargs)
 
 
+def create_rest_session():
+    """Create a keep-alive HTTP session for the REST clients of a manager.
+    It can be shared by several clients, and used from several threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=REST_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_tenant_client(client, tenant):
+    """Get a client for another tenant, sharing this client's connections
+    and credentials.
+
+    Unlike set_client_tenant, this leaves the original client unchanged, so
+    several threads can each work with a different tenant at once.
+    """
+    http_client = client._client
+    return CloudifyClient(
+        host=http_client.host,
+        port=http_client.port,
+        protocol=http_client.protocol,
+        api_version=http_client.api_version,
+        headers=http_client.headers,
+        query_params=http_client.query_params,
+        cert=http_client.cert,
+        trust_all=http_client.trust_all,
+        tenant=tenant,
+        timeout=http_client.default_timeout_sec,
+        session=http_client._session,
+    )
+
+
 def test_cli_package_url(url):
     error_base = (
         # Trailing space for better readability when cause of error
@@ -141,6 +286,17 @@ def assert_snapshot_created(manager, snapshot_id):
     )
 
 
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a file, e.g. to coordinate xdist workers."""
+    with open(path, 'a') as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
 @contextmanager
 def set_client_tenant(client, tenant):
     if tenant:
@@ -394,56 +550,240 @@ def wait_for_execution(client, execution, logger, tenant=None, timeout=20*60,
             execution=execution['id'],
         )
     )
-    current_time = datetime.now()
-    timeout_time = current_time + timedelta(seconds=timeout)
-    output_events(client, execution, logger, to_time=current_time)
+    return wait_for_executions(client, [execution], logger, tenant=tenant,
+                               timeout=timeout,
+                               allow_client_error=allow_client_error)[0]
 
-    with set_client_tenant(client, tenant):
+
+def wait_for_executions(client, executions, logger, tenant=None,
+                        timeout=20*60, allow_client_error=False):
+    """Wait for all of the executions to end, returning their final states.
+    An error is raised as soon as any of them fails.
+    """
+    waiter = get_execution_waiter(client)
+    futures = [
+        waiter.watch(execution, logger, tenant=tenant, timeout=timeout,
+                     allow_client_error=allow_client_error)
+        for execution in executions
+    ]
+    for _ in results_as_completed(futures):
+        pass
+    return [future.result() for future in futures]
+
+
+class _ExecutionWatch(object):
+    """The shared polling state of one execution."""
+
+    def __init__(self, execution, tenant, client):
+        self.execution = execution
+        self.tenant = tenant
+        self.client = client
+        self.events = None
+        self.ended = False
+        self.subscriptions = []
+
+    @property
+    def execution_id(self):
+        return self.execution['id']
+
+
+class _ExecutionSubscription(object):
+    """One caller waiting for an execution, with its own future, logger and
+    deadline.
+    """
+
+    def __init__(self, logger, timeout, allow_client_error):
+        self.logger = logger
+        self.deadline = time.time() + timeout
+        self.allow_client_error = allow_client_error
+        self.future = Future()
+
+    def timed_out(self):
+        return time.time() >= self.deadline
+
+
+class ExecutionWaiter(object):
+    """Waits for executions on one manager using a single poller thread.
+
+    Every poll retrieves all of the watched executions for a tenant with one
+    request, and retrieves any new events for each of them by offset.
+    Each waiter is given its own future, which is resolved when the execution
+    ends (or that waiter's timeout is reached), so several waiters can watch
+    the same execution without affecting each other.
+    """
+
+    def __init__(self, client, poll_interval=2):
+        # The client is only held weakly, so that its entry in
+        # _execution_waiters can be collected. Polling uses tenant views.
+        self._client_ref = weakref.ref(client)
+        self._poll_interval = poll_interval
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._poller = None
+        self._end_callbacks = []
+
+    def add_end_callback(self, callback):
+        """Call callback(execution) whenever a watched execution ends."""
+        with self._lock:
+            self._end_callbacks.append(callback)
+
+    def watch(self, execution, logger, tenant=None, timeout=20*60,
+              allow_client_error=False):
+        client = self._client_ref()
+        # The poller must not see the client's tenant header changing (e.g.
+        # with set_client_tenant) while it works, so it uses a view of the
+        # tenant the client is using now.
+        tenant = tenant or client._client.headers.get(CLOUDIFY_TENANT_HEADER)
+        subscription = _ExecutionSubscription(logger, timeout,
+                                              allow_client_error)
+        with self._lock:
+            watch = self._watches.get(execution['id'])
+            if watch is None:
+                watch = _ExecutionWatch(execution, tenant,
+                                        get_tenant_client(client, tenant))
+                self._watches[execution['id']] = watch
+            watch.subscriptions.append(subscription)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll,
+                                                daemon=True)
+                self._poller.start()
+        return subscription.future
+
+    def _poll(self):
         while True:
-            prev_time = current_time
-            current_time = datetime.now()
+            with self._lock:
+                for execution_id, watch in list(self._watches.items()):
+                    # Drop anyone resolved, or cancelled by their caller
+                    watch.subscriptions = [
+                        subscription for subscription in watch.subscriptions
+                        if not subscription.future.done()
+                    ]
+                    if not watch.subscriptions:
+                        self._watches.pop(execution_id)
+                if not self._watches:
+                    self._poller = None
+                    return
+                watches = list(self._watches.values())
+
+            by_tenant = {}
+            for watch in watches:
+                by_tenant.setdefault(watch.tenant, []).append(watch)
 
             try:
-                execution = client.executions.get(execution['id'])
+                for tenant_watches in by_tenant.values():
+                    self._check_executions(tenant_watches)
+            except Exception as err:
+                # Don't leave anyone waiting forever on a dead poller
+                for watch in watches:
+                    for subscription in list(watch.subscriptions):
+                        self._resolve(subscription, error=err)
+
+            time.sleep(self._poll_interval)
+
+    def _check_executions(self, watches):
+        client = watches[0].client
+        try:
+            executions = {
+                execution['id']: execution
+                for execution in client.executions.list(
+                    id=[watch.execution_id for watch in watches],
+                    _get_all_results=True,
+                )
+            }
+        except CloudifyClientError as err:
+            for watch in watches:
+                self._client_error(watch, err)
+            return
 
-                output_events(client, execution, logger, prev_time,
-                              current_time)
-            except UserUnauthorizedError:
-                # This is a specific client error which we don't want to catch
-                # as it can't get better with retries.
-                raise
+        for watch in watches:
+            execution = executions.get(watch.execution_id)
+            if execution is None:
+                self._client_error(watch, CloudifyClientError(
+                    'Execution {} not found'.format(watch.execution_id)))
+                continue
+            try:
+                self._output_new_events(watch)
             except CloudifyClientError as err:
-                if allow_client_error:
-                    logger.warning(
-                        'Error trying to get execution state, retrying: %s',
-                        err
-                    )
-                    if current_time >= timeout_time:
-                        raise
-                    time.sleep(2)
+                self._client_error(watch, err)
+                continue
+
+            watch.execution = execution
+            if execution.status in execution.END_STATES:
+                if not watch.ended:
+                    # Give time for any last second events by collecting them
+                    # on the next poll before finishing.
+                    watch.ended = True
+                    for callback in list(self._end_callbacks):
+                        callback(execution)
                     continue
-                else:
-                    raise
+                for subscription in list(watch.subscriptions):
+                    if execution.status != execution.TERMINATED:
+                        self._fail(watch, subscription, 'failed')
+                    else:
+                        subscription.logger.info(
+                            'Execution completed in state {status}'.format(
+                                status=execution.status,
+                            )
+                        )
+                        self._resolve(subscription, result=execution)
+            else:
+                for subscription in list(watch.subscriptions):
+                    if subscription.timed_out():
+                        self._fail(watch, subscription, 'timeout')
+
+    def _output_new_events(self, watch):
+        if watch.events is None:
+            watch.events = EventTailer(watch.client, watch.execution_id)
+        events = list(watch.events.poll())
+        loggers = []
+        for subscription in list(watch.subscriptions):
+            if subscription.logger not in loggers:
+                loggers.append(subscription.logger)
+        for logger in loggers:
+            _log_events(events, logger)
+
+    def _client_error(self, watch, err):
+        for subscription in list(watch.subscriptions):
+            # UserUnauthorizedError is a specific client error which we don't
+            # want to retry as it can't get better with retries.
+            if (
+                subscription.allow_client_error
+                and not isinstance(err, UserUnauthorizedError)
+                and not subscription.timed_out()
+            ):
+                subscription.logger.warning(
+                    'Error trying to get execution state, retrying: %s', err,
+                )
+            else:
+                self._resolve(subscription, error=err)
 
-            if current_time >= timeout_time:
-                _fail_wait_for_execution(client, logger, execution, 'timeout')
+    def _fail(self, watch, subscription, error_type):
+        try:
+            _fail_wait_for_execution(watch.client, subscription.logger,
+                                     watch.execution, error_type)
+        except Exception as err:
+            self._resolve(subscription, error=err)
+
+    def _resolve(self, subscription, result=None, error=None):
+        with self._lock:
+            if subscription.future.done():
+                return
+            if error is None:
+                subscription.future.set_result(result)
+            else:
+                subscription.future.set_exception(error)
 
-            if execution.status in execution.END_STATES:
-                # Give time for any last second events
-                time.sleep(2)
-                output_events(client, execution, logger, current_time)
 
-                if execution.status != execution.TERMINATED:
-                    _fail_wait_for_execution(client, logger, execution,
-                                             'failed')
+_execution_waiters = weakref.WeakKeyDictionary()
+_execution_waiters_lock = threading.Lock()
 
-                logger.info('Execution completed in state {status}'.format(
-                        status=execution.status,
-                    )
-                )
-                break
 
-    return execution
+def get_execution_waiter(client):
+    """Get the shared execution waiter for this client."""
+    with _execution_waiters_lock:
+        if client not in _execution_waiters:
+            _execution_waiters[client] = ExecutionWaiter(client)
+        return _execution_waiters[client]
 
 
 def _fail_wait_for_execution(client, logger, execution, error_type):
@@ -453,7 +793,7 @@ def _fail_wait_for_execution(client, logger, execution, error_type):
     }
 
     logger.error('Failure waiting for execution. Execution %s', error_type)
-    events = client.events.list(execution['id'])
+    events = EventTailer(client, execution['id']).poll()
     for event in events:
         logger.error('{reported_timestamp} {message}'.format(**event))
     raise exceptions[error_type](
@@ -481,19 +821,61 @@ def run_blocking_execution(client, deployment_id, workflow_id, logger,
                        tenant=tenant, timeout=timeout)
 
 
-def output_events(client, execution, logger, from_time=None, to_time=None):
-    if from_time:
-        from_time = from_time.strftime('%Y-%m-%d %H:%M:%S')
-    if to_time:
-        to_time = to_time.strftime('%Y-%m-%d %H:%M:%S')
-    events = client.events.list(
-        execution_id=execution.id,
-        _size=1000,
-        include_logs=True,
-        sort='reported_timestamp',
-        from_datetime=from_time,
-        to_datetime=to_time,
-    )
+class EventTailer(object):
+    """Follows the events (and logs) of an execution as they are stored.
+
+    Events are paged through by offset, in the order of the timestamps the
+    manager stored them with. Events and logs which share a timestamp can
+    come back in a different order on each request, so each request starts
+    again from the first of those tied at the latest timestamp seen, and
+    skips as many of each as were already yielded. That way none are skipped
+    or repeated, while identical events (e.g. of a retried operation) are
+    all still yielded.
+    """
+    page_size = 1000
+    key_fields = ('timestamp', 'reported_timestamp', 'type', 'event_type',
+                  'level', 'node_instance_id', 'message')
+
+    def __init__(self, client, execution_id, include_logs=True):
+        self._client = client
+        self._execution_id = execution_id
+        self._include_logs = include_logs
+        # The offset of the first event at the latest timestamp seen, and
+        # how many of each of the events at that timestamp were yielded
+        self._offset = 0
+        self._tied_timestamp = None
+        self._tied = Counter()
+
+    def poll(self):
+        """Yield the events stored since the last poll."""
+        while True:
+            # The tied events are fetched again, along with a page of others
+            size = sum(self._tied.values()) + self.page_size
+            events = self._client.events.list(
+                execution_id=self._execution_id,
+                include_logs=self._include_logs,
+                sort='timestamp',
+                _offset=self._offset,
+                _size=size,
+            )
+            repeated = Counter(self._tied)
+            for event in events:
+                key = tuple(event.get(field) for field in self.key_fields)
+                if event.get('timestamp') != self._tied_timestamp:
+                    self._offset += sum(self._tied.values())
+                    self._tied_timestamp = event.get('timestamp')
+                    self._tied = Counter()
+                    repeated = Counter()
+                elif repeated[key]:
+                    repeated[key] -= 1
+                    continue
+                self._tied[key] += 1
+                yield event
+            if len(events) < size:
+                return
+
+
+def _log_events(events, logger):
     log_methods = {
         'debug': logger.debug,
         'info': logger.info,
@@ -585,35 +967,113 @@ def create_deployment(client, blueprint_id, deployment_id, logger,
     )
 
 
+def seed_deployments(client, deployments, logger, install=True,
+                     concurrency=20):
+    """Create many deployments at once, and optionally install them.
+
+    Creations and installs are started with up to `concurrency` requests in
+    flight, and all of the resulting executions are waited for together.
+
+    :param deployments: (blueprint ID, deployment ID) pairs. The blueprints
+                        must already have been uploaded.
+    """
+    deployments = list(deployments)
+    for blueprint_id in sorted({blueprint for blueprint, _ in deployments}):
+        wait_for_blueprint_upload(client, blueprint_id)
+
+    logger.info('Creating %d deployments', len(deployments))
+    parallel_map(
+        lambda deployment: client.deployments.create(
+            blueprint_id=deployment[0],
+            deployment_id=deployment[1],
+        ),
+        deployments,
+        max_workers=concurrency,
+    )
+    deployment_ids = {deployment_id for _, deployment_id in deployments}
+    env_creations = [
+        execution for execution in client.executions.list(
+            workflow_id='create_deployment_environment',
+            _include=['id', 'deployment_id', 'workflow_id', 'status'],
+            _get_all_results=True,
+        )
+        if execution['deployment_id'] in deployment_ids
+    ]
+    missing = deployment_ids - {
+        execution['deployment_id'] for execution in env_creations
+    }
+    if missing:
+        raise DeploymentCreationError(
+            'Deployment environment creation workflow not found for '
+            '{}'.format(', '.join(sorted(missing))))
+    logger.info('Waiting for deployment env creations')
+    wait_for_executions(client, env_creations, logger)
+
+    if install:
+        logger.info('Installing %d deployments', len(deployments))
+        installs = parallel_map(
+            lambda deployment_id: client.executions.start(deployment_id,
+                                                          'install'),
+            sorted(deployment_ids),
+            max_workers=concurrency,
+        )
+        wait_for_executions(client, installs, logger)
+
+
 class DeploymentDeletionError(Exception):
     """Deployment deletion failed."""
 
 
 def delete_deployment(client, deployment_id, logger):
-    logger.info('Deleting deployment %s', deployment_id)
-    client.deployments.delete(deployment_id)
-    # Allow a short delay to allow some time for the deletion
-    time.sleep(0.5)
-
-    for _ in range(40):
-        found = False
-        deployments = client.deployments.list()
-        if not deployments:
-            break
-        for deployment in deployments:
-            if deployment['id'] == deployment_id:
-                found = True
-                logger.info('Still waiting for deployment %s to delete',
-                            deployment_id)
-                time.sleep(2)
-                break
-
-    if found:
-        raise DeploymentDeletionError(
-            'Deployment {} did not finish deleting.'.format(
-                deployment_id,
+    delete_deployments(client, [deployment_id], logger)
+
+
+def delete_deployments(client, deployment_ids, logger, concurrency=None,
+                       timeout=80):
+    """Delete deployments, waiting for all of them to finish deleting.
+
+    At most `concurrency` deletions will be in progress at once. All of the
+    pending deletions are tracked with one deployments list per poll.
+    Returns how long each deployment took to delete, in seconds.
+
+    :param timeout: How long to wait for each deletion, in seconds.
+    """
+    queued = list(deployment_ids)
+    concurrency = concurrency or len(queued)
+    pending = {}
+    durations = {}
+    while queued or pending:
+        while queued and len(pending) < concurrency:
+            deployment_id = queued.pop(0)
+            logger.info('Deleting deployment %s', deployment_id)
+            client.deployments.delete(deployment_id)
+            pending[deployment_id] = time.time()
+        # Allow a short delay to allow some time for the deletion
+        time.sleep(0.5)
+
+        remaining = {
+            deployment['id']
+            for deployment in client.deployments.list(
+                id=list(pending),
+                _include=['id'],
+                _get_all_results=True,
             )
-        )
+        }
+        for deployment_id, started in list(pending.items()):
+            if deployment_id not in remaining:
+                durations[deployment_id] = time.time() - started
+                del pending[deployment_id]
+            elif time.time() - started > timeout:
+                raise DeploymentDeletionError(
+                    'Deployment {} did not finish deleting.'.format(
+                        deployment_id,
+                    )
+                )
+        if pending and (not queued or len(pending) >= concurrency):
+            logger.info('Still waiting for deployments to delete: %s',
+                        ', '.join(sorted(pending)))
+            time.sleep(2)
+    return durations
 
 
 @retrying.retry(stop_max_attempt_number=100, wait_fixed=250)
@@ -637,20 +1097,73 @@ def cancel_install(example, deployment_id):
     example.manager.client.executions.cancel(exec_list[0].id)
 
 
+# The node instance fields we use, so that listing doesn't return the rest
+NODE_INSTANCE_FIELDS = ['id', 'node_id', 'deployment_id', 'host_id', 'state',
+                        'runtime_properties', 'version']
+
+
 def get_node_instances(node_name, deployment_id, client):
-    node_instances = []
+    return [
+        inst for inst in _list_node_instances(client, deployment_id)
+        if inst['node_id'] == node_name
+    ]
+
 
-    node_instance_list = client.node_instances.list(
+def _list_node_instances(client, deployment_id):
+    return client.node_instances.list(
         deployment_id=deployment_id,
+        _include=NODE_INSTANCE_FIELDS,
     )
 
-    for inst in node_instance_list:
-        if inst['node_id'] == node_name:
-            node_instances.append(client.node_instances.get(
-                inst['id'],
-            ))
 
-    return node_instances
+class NodeInstanceCache(object):
+    """Node instances of a manager's deployments, listed once per deployment.
+
+    A deployment's cached node instances are dropped whenever one of its
+    executions ends (as seen by the client's execution waiter), so they will
+    be listed again on the next lookup.
+    """
+
+    def __init__(self, client):
+        # Only held weakly, so that the client's entry in
+        # _node_instance_caches can be collected
+        self._client_ref = weakref.ref(client)
+        self._lock = threading.Lock()
+        self._deployments = {}
+        get_execution_waiter(client).add_end_callback(self._execution_ended)
+
+    def get(self, node_name, deployment_id):
+        client = self._client_ref()
+        tenant = client._client.headers.get(CLOUDIFY_TENANT_HEADER)
+        key = (tenant, deployment_id)
+        with self._lock:
+            if key not in self._deployments:
+                by_node = {}
+                for inst in _list_node_instances(client, deployment_id):
+                    by_node.setdefault(inst['node_id'], []).append(inst)
+                self._deployments[key] = by_node
+            return list(self._deployments[key].get(node_name, []))
+
+    def invalidate(self, deployment_id):
+        with self._lock:
+            for key in list(self._deployments):
+                if key[1] == deployment_id:
+                    self._deployments.pop(key)
+
+    def _execution_ended(self, execution):
+        self.invalidate(execution['deployment_id'])
+
+
+_node_instance_caches = weakref.WeakKeyDictionary()
+_node_instance_caches_lock = threading.Lock()
+
+
+def get_node_instance_cache(client):
+    """Get the shared node instance cache for this client."""
+    with _node_instance_caches_lock:
+        if client not in _node_instance_caches:
+            _node_instance_caches[client] = NodeInstanceCache(client)
+        return _node_instance_caches[client]
 
 
 def update_dictionary(dict1, dict2):
@@ -711,6 +1224,58 @@ def get_manager_install_version(host):
     return version.stdout
 
 
+def upload_shared_blueprints(client, blueprints, logger, legacy=False):
+    """Upload blueprints for use by every tenant, unless they're already there.
+
+    The blueprints are uploaded to the default tenant with global visibility,
+    with IDs based on their content, so each version of a blueprint is only
+    uploaded once.
+
+    :param blueprints: Dict of blueprint names to their paths.
+    :returns: Dict of blueprint names to their IDs on the manager.
+    """
+    blueprint_ids = {}
+    for name, path in blueprints.items():
+        with open(path, 'rb') as blueprint_handle:
+            digest = hashlib.sha256(blueprint_handle.read()).hexdigest()
+        blueprint_ids[name] = '{}-{}'.format(name, digest[:12])
+
+    client = get_tenant_client(client, 'default_tenant')
+    existing = {
+        blueprint['id']: blueprint['state']
+        for blueprint in client.blueprints.list(
+            id=list(blueprint_ids.values()),
+            _include=['id', 'state'],
+            _get_all_results=True,
+        )
+    }
+    for name, blueprint_id in blueprint_ids.items():
+        state = existing.get(blueprint_id)
+        if state and (state.startswith('failed') or state == 'invalid'):
+            logger.info('Replacing blueprint %s in state %s',
+                        blueprint_id, state)
+            client.blueprints.delete(blueprint_id)
+            state = None
+        if state:
+            logger.info('Using existing blueprint %s', blueprint_id)
+            continue
+        logger.info('Uploading blueprint %s', blueprint_id)
+        try:
+            client.blueprints.upload(
+                blueprints[name], blueprint_id, visibility='global',
+                async_upload=True, legacy=legacy,
+            )
+        except CloudifyClientError as err:
+            if err.status_code != 409:
+                raise
+            logger.info('Blueprint %s is being uploaded elsewhere',
+                        blueprint_id)
+    for blueprint_id in blueprint_ids.values():
+        wait_for_blueprint_upload(client, blueprint_id)
+
+    return blueprint_ids
+
+
 @retrying.retry(stop_max_attempt_number=120, wait_fixed=1000)
 def wait_for_blueprint_upload(client, blueprint_id):
     blueprint = client.blueprints.get(blueprint_id)
@@ -727,9 +1292,36 @@ def substitute_testing_version(original_string, testing_version, distro=''):
     )
 
 
+def wait_for_async_commands(waits, timeout=ASYNC_COMMAND_TIMEOUT):
+    """Wait for async commands to finish on many nodes at once.
+
+    :param waits: (node, process_name) pairs, e.g. (node, 'Rsync backup').
+    :param timeout: How long to wait for all of the commands, in seconds.
+    """
+    node_waits = {}
+    for node, process_name in waits:
+        node_waits.setdefault(node, []).append(process_name)
+    deadline = time.time() + timeout
+
+    def _wait(node, process_names):
+        for process_name in process_names:
+            node.wait_for_async_command(process_name,
+                                        timeout=deadline - time.time())
+
+    parallel_map(lambda item: _wait(*item), node_waits.items())
+
+
+def wait_for_bootstraps(nodes, timeout=ASYNC_COMMAND_TIMEOUT):
+    """Wait for non-blocking bootstraps to finish on many nodes at once."""
+    parallel_map(lambda node: node.wait_for_bootstrap(timeout=timeout),
+                 nodes)
+
+
 def reboot_if_required(nodes):
+    started = {}
     for node in nodes:
         if node.reboot_required:
+            started[node] = time.time()
             node.wait_for_ssh()
             node.log_action('Clearing temp and rebooting')
             node.run_command('rm -rf /tmp/*', warn_only=True, use_sudo=True)
@@ -740,18 +1332,68 @@ def reboot_if_required(nodes):
     for node in nodes:
         if node.reboot_required:
             node.wait_for_ssh()
+            node.reboot_required = False
             node.log_action('Restart complete')
+            timeline.record('Reboot', started[node], time.time(),
+                            node.deployment_id)
 
 
-def rsync_restore(nodes):
+def rsync_restore(nodes, backup_dir=RSYNC_BACKUP_DIR):
+    start = time.time()
     for node in nodes:
-        node.rsync_restore()
+        node.rsync_restore(backup_dir)
         node.log_action('Waiting for rsync restore')
-    for node in nodes:
-        while not node.async_command_is_complete('Rsync restore'):
-            time.sleep(3)
-        node.log_action('Rsync restore complete')
-        node.reboot_required = True
+    parallel_map(functools.partial(_finish_rsync_restore, start=start), nodes)
+
+
+def leave_checkpoints(nodes):
+    """Restore any of these nodes which were left at a checkpoint (e.g. a
+    bootstrapped one) to their pre-test backup instead, then reboot any of
+    them which need it.
+
+    Any reboot required by the restore to the checkpoint is combined with
+    one required by this restore, so that no node is rebooted twice.
+    """
+    checkpointed = [node for node in nodes if node.checkpoint]
+    if checkpointed:
+        rsync_restore(checkpointed)
+    reboot_if_required(nodes)
+
+
+def used_by_later_tests(request, fixture_name):
+    """Whether any test collected after the current one uses this fixture.
+
+    Under xdist every worker collects the whole session but only runs part
+    of it, so those later tests may run on other workers. This is only
+    reliable when the tests using the fixture run on one worker, e.g. when
+    they share an xdist group and are run with --dist loadgroup.
+    """
+    items = request.session.items
+    later = items[items.index(request.node) + 1:]
+    return any(fixture_name in item.fixturenames for item in later)
+
+
+def _finish_rsync_restore(node, start):
+    node.wait_for_async_command('Rsync restore')
+    timeline.record('Rsync restore (total)', start, time.time(),
+                    node.deployment_id)
+    result = node.get_rsync_restore_result()
+    # Runtime state (e.g. a test's firewall rules, routes or processes) also
+    # survives a restore, so it must be reset as a reboot would have. A
+    # reboot still pending from an earlier restore is kept.
+    node.reboot_required = (node.reboot_required
+                            or result.reboot_required
+                            or not node.reset_runtime_state())
+    node.log_action(
+        'Rsync restore complete after {duration:.0f}s ({changed} paths '
+        'changed, {size} bytes copied, {reboot})'.format(
+            duration=time.time() - start,
+            changed=len(result.changed_paths),
+            size=result.transferred_bytes,
+            reboot=('reboot required' if node.reboot_required
+                    else 'no reboot required'),
+        )
+    )
 
 
 def generate_password():
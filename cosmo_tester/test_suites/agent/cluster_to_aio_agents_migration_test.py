@@ -1,5 +1,3 @@
-from os.path import join
-
 import pytest
 
 from cosmo_tester.test_suites.agent import validate_agent
@@ -11,8 +9,8 @@ from cosmo_tester.test_suites.snapshots import (
 
 @pytest.mark.four_vms
 def test_migrate_agents_cluster_to_aio(
-        three_node_cluster_with_extra_manager, module_tmpdir,
-        ssh_key, logger, test_config):
+        three_node_cluster_with_extra_manager, ssh_key, logger,
+        test_config):
     node1, node2, node3, aio_mgr = three_node_cluster_with_extra_manager
     aio_mgr.bootstrap()
 
@@ -25,10 +23,9 @@ def test_migrate_agents_cluster_to_aio(
 
     logger.info('Creating snapshot on cluster')
     snapshot_id = 'cluster_to_aio_agents'
-    snapshot_path = join(str(module_tmpdir), snapshot_id) + '.zip'
 
     create_copy_and_restore_snapshot(
-        node1, aio_mgr, snapshot_id, snapshot_path, logger,
+        node1, aio_mgr, snapshot_id, logger,
         cert_path=aio_mgr.api_ca_path)
 
     logger.info('Migrating to new agents, stopping old agents')
@@ -46,8 +43,8 @@ def test_migrate_agents_cluster_to_aio(
 
 @pytest.mark.four_vms
 def test_migrate_agents_aio_to_cluster(
-        three_node_cluster_with_extra_manager, module_tmpdir,
-        ssh_key, logger, test_config):
+        three_node_cluster_with_extra_manager, ssh_key, logger,
+        test_config):
     node1, node2, node3, aio_mgr = three_node_cluster_with_extra_manager
     aio_mgr.bootstrap()
 
@@ -60,10 +57,9 @@ def test_migrate_agents_aio_to_cluster(
 
     logger.info('Creating snapshot on AIO manager')
     snapshot_id = 'aio_to_cluster_agents'
-    snapshot_path = join(str(module_tmpdir), snapshot_id) + '.zip'
 
     create_copy_and_restore_snapshot(
-        aio_mgr, node1, snapshot_id, snapshot_path, logger,
+        aio_mgr, node1, snapshot_id, logger,
         cert_path=aio_mgr.api_ca_path)
 
     for mgr in node1, node2, node3:
@@ -10,8 +10,7 @@ from cosmo_tester.test_suites.agent import validate_agent, AGENT_OSES
 
 
 def test_old_agent_stopped_after_upgrade(ssh_key, module_tmpdir,
-                                         test_config, logger, tmpdir,
-                                         request):
+                                         test_config, logger, request):
     hosts = Hosts(ssh_key, module_tmpdir, test_config, logger, request,
                   len(AGENT_OSES) + 2)
     old_manager, new_manager = hosts.instances[:2]
@@ -48,11 +47,10 @@ def test_old_agent_stopped_after_upgrade(ssh_key, module_tmpdir,
             example.upload_and_verify_install()
             validate_agent(old_manager, example, test_config)
 
-        local_snapshot_path = str(tmpdir / 'snapshot.zip')
         snapshot_id = 'snap'
 
         create_copy_and_restore_snapshot(
-            old_manager, new_manager, snapshot_id, local_snapshot_path, logger,
+            old_manager, new_manager, snapshot_id, logger,
             wait_for_post_restore_commands=True)
 
         for agent_os in AGENT_OSES:
@@ -1,10 +1,13 @@
 import pytest
 
+from cosmo_tester.framework.util import leave_checkpoints
+
 
 @pytest.fixture(scope='function')
 def bootstrap_test_manager(session_manager):
     """Prepares a bootstrappable manager."""
     session_manager.wait_for_ssh()
+    leave_checkpoints([session_manager])
     # We don't bootstrap here because bootstrapping in the test means that
     # --pdb will actually be useful as it'll allow investigation before
     # teardown on bootstrap failure
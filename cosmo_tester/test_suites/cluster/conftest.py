@@ -1,11 +1,13 @@
-import os
+import copy
+import functools
 import time
 
 from os.path import join, dirname
 import pytest
 
+from cosmo_tester.framework.constants import RSYNC_CLUSTER_BACKUP_DIR
 from cosmo_tester.framework.test_hosts import Hosts
-from cosmo_tester.framework import util
+from cosmo_tester.framework import certificates, timeline, util
 from .cfy_cluster_manager_shared import REMOTE_CLUSTER_CONFIG_PATH
 
 CONFIG_DIR = join(dirname(__file__), 'config')
@@ -15,6 +17,26 @@ class InsufficientVmsError(Exception):
     pass
 
 
+# Node attributes set while bootstrapping a cluster, which are needed to use
+# it again after it is restored from a checkpoint
+CHECKPOINT_NODE_ATTRIBUTES = [
+    'hostname', 'friendly_name', 'install_config', 'basic_install_config',
+    'restservice_expected', 'pg_password', 'api_ca_path', 'local_cert',
+    'local_key', 'remote_cert', 'remote_key', 'remote_ca',
+]
+
+# The installed configs whose services must be started across a whole
+# cluster before any of the next ones: brokers, then DBs, then managers
+CLUSTER_START_ORDER = [
+    '/etc/cloudify/{}_config.yaml'.format(config_name)
+    for config_name in ['rabbit', 'db', 'manager']
+]
+
+# The checkpoint of a cluster bootstrapped this session, by its VMs. Only one
+# is kept on each set of VMs, as each is a full backup of its nodes.
+_cluster_checkpoints = {}
+
+
 def skip(*args, **kwargs):
     return True
 
@@ -126,18 +148,13 @@ def nine_session_vms_fqdns(request, ssh_key, session_tmpdir, test_config,
 
 @pytest.fixture(scope='function')
 def brokers(three_session_vms, test_config, logger, request):
-    util.reboot_if_required(three_session_vms)
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(three_session_vms, test_config, logger,
-                     broker_count=3)
-    if len(request.session.items) > 1:
-        util.rsync_restore(three_session_vms)
+    yield from _cluster_fixture(
+        request, three_session_vms, test_config, logger, broker_count=3)
 
 
 @pytest.fixture(scope='function')
 def broker(session_manager, test_config, logger, request):
-    util.reboot_if_required([session_manager])
+    util.leave_checkpoints([session_manager])
     _brokers = _get_hosts([session_manager], test_config, logger,
                           broker_count=1)
     yield _brokers[0]
@@ -147,118 +164,79 @@ def broker(session_manager, test_config, logger, request):
 
 @pytest.fixture(scope='function')
 def dbs(three_session_vms, test_config, logger, request):
-    util.reboot_if_required(three_session_vms)
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(three_session_vms, test_config, logger,
-                     db_count=3)
-    if len(request.session.items) > 1:
-        util.rsync_restore(three_session_vms)
+    yield from _cluster_fixture(
+        request, three_session_vms, test_config, logger, db_count=3)
 
 
 @pytest.fixture(scope='function')
 def brokers_and_manager(three_session_vms, test_config, logger, request):
-    util.reboot_if_required(three_session_vms)
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(three_session_vms, test_config, logger,
-                     broker_count=2, manager_count=1)
-    if len(request.session.items) > 1:
-        util.rsync_restore(three_session_vms)
+    yield from _cluster_fixture(
+        request, three_session_vms, test_config, logger, broker_count=2,
+        manager_count=1)
 
 
 @pytest.fixture(scope='function')
 def brokers3_and_manager(four_session_vms, test_config, logger, request):
-    util.reboot_if_required(four_session_vms)
-    yield _get_hosts(four_session_vms, test_config, logger,
-                     broker_count=3, manager_count=1)
-    if len(request.session.items) > 1:
-        util.rsync_restore(four_session_vms)
+    yield from _cluster_fixture(
+        request, four_session_vms, test_config, logger, ensure_installer=False,
+        broker_count=3, manager_count=1)
 
 
 @pytest.fixture(scope='function')
 def full_cluster_ips(nine_session_vms, test_config, logger, request):
-    util.reboot_if_required(nine_session_vms)
-    for vm in nine_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(nine_session_vms, test_config, logger,
-                     broker_count=3, db_count=3, manager_count=3,
-                     pre_cluster_rabbit=True)
-    if len(request.session.items) > 1:
-        util.rsync_restore(nine_session_vms)
+    yield from _cluster_fixture(
+        request, nine_session_vms, test_config, logger, broker_count=3,
+        db_count=3, manager_count=3, pre_cluster_rabbit=True)
 
 
 @pytest.fixture(scope='function')
 def full_cluster_names(nine_session_vms, test_config, logger, request):
-    util.reboot_if_required(nine_session_vms)
-    for vm in nine_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(nine_session_vms, test_config, logger,
-                     broker_count=3, db_count=3, manager_count=3,
-                     pre_cluster_rabbit=True, use_hostnames=True)
-    if len(request.session.items) > 1:
-        util.rsync_restore(nine_session_vms)
+    yield from _cluster_fixture(
+        request, nine_session_vms, test_config, logger, broker_count=3,
+        db_count=3, manager_count=3, pre_cluster_rabbit=True,
+        use_hostnames=True)
 
 
 @pytest.fixture(scope='function')
 def cluster_missing_one_db(nine_session_vms, test_config, logger, request):
-    util.reboot_if_required(nine_session_vms)
-    for vm in nine_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(nine_session_vms, test_config, logger,
-                     broker_count=3, db_count=3, manager_count=3,
-                     skip_bootstrap_list=['db3'],
-                     pre_cluster_rabbit=True)
-    if len(request.session.items) > 1:
-        util.rsync_restore(nine_session_vms)
+    yield from _cluster_fixture(
+        request, nine_session_vms, test_config, logger, broker_count=3,
+        db_count=3, manager_count=3, skip_bootstrap_list=['db3'],
+        pre_cluster_rabbit=True)
 
 
 @pytest.fixture(scope='function')
 def cluster_with_single_db(six_session_vms, test_config, logger, request):
-    util.reboot_if_required(six_session_vms)
-    yield _get_hosts(six_session_vms, test_config, logger,
-                     broker_count=3, db_count=1, manager_count=2,
-                     pre_cluster_rabbit=True)
-    if len(request.session.items) > 1:
-        util.rsync_restore(six_session_vms)
+    yield from _cluster_fixture(
+        request, six_session_vms, test_config, logger, ensure_installer=False,
+        broker_count=3, db_count=1, manager_count=2, pre_cluster_rabbit=True)
 
 
 @pytest.fixture(scope='function')
 def minimal_cluster(four_session_vms, test_config, logger, request):
-    util.reboot_if_required(four_session_vms)
-    yield _get_hosts(four_session_vms, test_config, logger,
-                     broker_count=1, db_count=1, manager_count=2,
-                     pre_cluster_rabbit=True)
-    if len(request.session.items) > 1:
-        util.rsync_restore(four_session_vms)
+    yield from _cluster_fixture(
+        request, four_session_vms, test_config, logger, ensure_installer=False,
+        broker_count=1, db_count=1, manager_count=2, pre_cluster_rabbit=True)
 
 
 @pytest.fixture(scope='function')
 def three_nodes_cluster(three_session_vms, test_config, logger, request):
-    util.reboot_if_required(three_session_vms)
-    for vm in three_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(three_session_vms, test_config, logger,
-                     pre_cluster_rabbit=True, three_nodes_cluster=True)
-    if len(request.session.items) > 1:
-        util.rsync_restore(three_session_vms)
+    yield from _cluster_fixture(
+        request, three_session_vms, test_config, logger,
+        pre_cluster_rabbit=True, three_nodes_cluster=True)
 
 
 @pytest.fixture(scope='function')
 def three_nodes_ipv6_cluster(three_ipv6_session_vms, test_config, logger,
                              request):
-    util.reboot_if_required(three_ipv6_session_vms)
-    for vm in three_ipv6_session_vms:
-        _ensure_installer_installed(vm)
-    yield _get_hosts(three_ipv6_session_vms, test_config, logger,
-                     pre_cluster_rabbit=True, three_nodes_cluster=True)
-    if len(request.session.items) > 1:
-        util.rsync_restore(three_ipv6_session_vms)
+    yield from _cluster_fixture(
+        request, three_ipv6_session_vms, test_config, logger,
+        pre_cluster_rabbit=True, three_nodes_cluster=True)
 
 
 @pytest.fixture(scope='function')
 def three_vms(three_session_vms, test_config, logger, request):
-    util.reboot_if_required(three_session_vms)
+    util.leave_checkpoints(three_session_vms)
     for vm in three_session_vms:
         _ensure_installer_not_installed(vm)
     yield _get_hosts(three_session_vms, test_config, logger,
@@ -280,7 +258,7 @@ def three_vms_fqdns(three_session_vms_fqdns, test_config, logger, request):
 
 @pytest.fixture(scope='function')
 def three_vms_ipv6(three_ipv6_session_vms, test_config, logger, request):
-    util.reboot_if_required(three_ipv6_session_vms)
+    util.leave_checkpoints(three_ipv6_session_vms)
     for vm in three_nodes_ipv6_cluster:
         _ensure_installer_not_installed(vm)
     yield _get_hosts(three_ipv6_session_vms, test_config, logger,
@@ -291,7 +269,7 @@ def three_vms_ipv6(three_ipv6_session_vms, test_config, logger, request):
 
 @pytest.fixture(scope='function')
 def nine_vms(nine_session_vms, test_config, logger, request):
-    util.reboot_if_required(nine_session_vms)
+    util.leave_checkpoints(nine_session_vms)
     for vm in nine_session_vms:
         _ensure_installer_not_installed(vm)
     yield _get_hosts(nine_session_vms, test_config, logger,
@@ -313,6 +291,154 @@ def nine_vms_fqdns(nine_session_vms_fqdns, test_config, logger, request):
         util.rsync_restore(nine_session_vms_fqdns)
 
 
+def _cluster_fixture(request, vms, test_config, logger, ensure_installer=True,
+                     **kwargs):
+    """Set up a cluster on the session VMs for one test, as _get_hosts does.
+
+    If later tests in the session use this fixture, the cluster is then
+    checkpointed, so that those tests restore it instead of bootstrapping it
+    again. A checkpoint which another fixture's later tests still need is not
+    replaced, though: this fixture then bootstraps the cluster for each test.
+    """
+    checkpoint = _cluster_checkpoints.get(tuple(vms))
+    if checkpoint and checkpoint.name == request.fixturename:
+        if not checkpoint.is_restored(vms):
+            # Another fixture's tests have used these VMs since the last test
+            # using this one
+            util.rsync_restore(vms, backup_dir=checkpoint.backup_dir)
+        util.reboot_if_required(vms)
+        checkpoint.resume()
+    else:
+        util.leave_checkpoints(vms)
+        if ensure_installer:
+            for vm in vms:
+                _ensure_installer_installed(vm)
+        _get_hosts(vms, test_config, logger, **kwargs)
+        if (
+            util.used_by_later_tests(request, request.fixturename)
+            and not (checkpoint
+                     and util.used_by_later_tests(request, checkpoint.name))
+        ):
+            checkpoint = ClusterCheckpoint(request.fixturename, vms)
+            checkpoint.save()
+            _cluster_checkpoints[tuple(vms)] = checkpoint
+        else:
+            checkpoint = None
+    yield vms
+    if len(request.session.items) > 1:
+        if checkpoint:
+            checkpoint.restore()
+        else:
+            util.rsync_restore(vms)
+
+
+class ClusterCheckpoint(object):
+    """A bootstrapped cluster, backed up on each of its nodes.
+
+    Services are started a role at a time across all of the nodes (brokers,
+    then DBs, then managers, as in CLUSTER_START_ORDER), as e.g. a DB cluster
+    must have its members started together. They are stopped in the reverse
+    order, so that the cluster is quiet while it is backed up or restored.
+    """
+
+    def __init__(self, name, nodes):
+        self.name = name
+        self.backup_dir = RSYNC_CLUSTER_BACKUP_DIR
+        self.nodes = list(nodes)
+        self.managers = [
+            node for node in self.nodes
+            if 'manager_service' in node.install_config.get(
+                'services_to_install', [])
+        ]
+        self._stages = []
+        self._node_attributes = {}
+        self._ca_certs = {}
+
+    def is_restored(self, nodes):
+        return list(nodes) == self.nodes and all(
+            node.checkpoint == self.backup_dir for node in self.nodes)
+
+    @timeline.traced
+    def save(self):
+        self._stages = self._get_stages()
+        self._stop()
+        # Replace the checkpoint of any other cluster on these nodes
+        util.parallel_map(
+            lambda node: node.run_command(
+                'rm -rf {}'.format(self.backup_dir), use_sudo=True),
+            self.nodes)
+        for node in self.nodes:
+            node.rsync_backup(backup_dir=self.backup_dir)
+        util.wait_for_async_commands(
+            (node, 'Rsync backup') for node in self.nodes)
+        self._start()
+        self._node_attributes = {
+            node: {
+                attribute: copy.deepcopy(getattr(node, attribute))
+                for attribute in CHECKPOINT_NODE_ATTRIBUTES
+                if hasattr(node, attribute)
+            }
+            for node in self.nodes
+        }
+        self._ca_certs = {}
+        for node in self.managers:
+            with open(node.api_ca_path, 'rb') as ca_handle:
+                self._ca_certs[node.api_ca_path] = ca_handle.read()
+
+    def restore(self):
+        self._stop()
+        util.rsync_restore(self.nodes, backup_dir=self.backup_dir)
+
+    @timeline.traced
+    def resume(self):
+        """Start a cluster which was restored to this checkpoint."""
+        for node in self.nodes:
+            for attribute, value in self._node_attributes[node].items():
+                setattr(node, attribute, copy.deepcopy(value))
+        # Restoring the managers removed their local copy of the CA
+        for ca_path, ca_cert in self._ca_certs.items():
+            with open(ca_path, 'wb') as ca_handle:
+                ca_handle.write(ca_cert)
+        self._start()
+
+    def _get_stages(self):
+        """Get the configs to start on each node, grouped into the stages
+        that they must be started in.
+        """
+        installed = dict(zip(self.nodes, util.parallel_map(
+            lambda node: node.get_installed_configs(), self.nodes)))
+        stages = [
+            {node: [config_path] for node in self.nodes
+             if config_path in installed[node]}
+            for config_path in CLUSTER_START_ORDER
+        ]
+        # e.g. an all-in-one config.yaml
+        stages.append({
+            node: [config_path for config_path in installed[node]
+                   if config_path not in CLUSTER_START_ORDER]
+            for node in self.nodes
+        })
+        return [
+            {node: configs for node, configs in stage.items() if configs}
+            for stage in stages
+        ]
+
+    def _start(self):
+        for stage in self._stages:
+            util.parallel_map(
+                lambda item: item[0].start_manager_services(configs=item[1]),
+                stage.items())
+        for node in self.managers:
+            node.client = node.get_rest_client(proto='https')
+            node.wait_for_manager()
+
+    def _stop(self):
+        for stage in reversed(self._stages):
+            util.parallel_map(
+                lambda item: item[0].stop_manager_services(configs=item[1]),
+                stage.items())
+
+
 def _ensure_installer_not_installed(vm):
     vm.wait_for_ssh()
     vm.run_command(
@@ -465,136 +591,121 @@ def _get_hosts(instances, test_config, logger,
     return instances
 
 
+@timeline.traced
 def run_cluster_bootstrap(dbs, brokers, managers, skip_bootstrap_list,
                           pre_cluster_rabbit, high_security, use_hostnames,
                           tempdir, test_config, credentials=None):
-    for node_num, node in enumerate(brokers, start=1):
-        _bootstrap_rabbit_node(node, node_num, brokers,
-                               skip_bootstrap_list, pre_cluster_rabbit,
-                               tempdir, use_hostnames, credentials)
-
-    for node_num, node in enumerate(dbs, start=1):
-        _bootstrap_db_node(node, node_num, dbs, skip_bootstrap_list,
-                           high_security, tempdir,
-                           use_hostnames, credentials)
-
-    # Ensure all backend nodes are up before installing managers
-    for node in brokers + dbs:
-        if node.friendly_name in skip_bootstrap_list:
+    """Bootstrap the cluster nodes in order of their dependencies.
+
+    The stages run one after another, bootstrapping their nodes concurrently:
+      - the first broker
+      - the other brokers and the DBs
+      - the first manager
+      - the other managers
+    A node with several roles in one stage (e.g. in a compact cluster) will
+    bootstrap them one after another, as they share the node's bootstrap
+    state.
+    """
+    rabbit_tasks = [
+        (node, 'rabbit', functools.partial(
+            _bootstrap_rabbit_node, node, node_num, brokers,
+            skip_bootstrap_list, pre_cluster_rabbit, tempdir, use_hostnames,
+            credentials))
+        for node_num, node in enumerate(brokers, start=1)
+    ]
+    db_tasks = [
+        (node, 'db', functools.partial(
+            _bootstrap_db_node, node, node_num, dbs, skip_bootstrap_list,
+            high_security, tempdir, use_hostnames, credentials))
+        for node_num, node in enumerate(dbs, start=1)
+    ]
+    manager_tasks = [
+        (node, 'manager', functools.partial(
+            _bootstrap_manager_node, node, node_num, dbs, brokers,
+            skip_bootstrap_list, pre_cluster_rabbit, high_security, tempdir,
+            test_config, use_hostnames, credentials))
+        for node_num, node in enumerate(managers, start=1)
+    ]
+    stages = [
+        rabbit_tasks[:1],
+        rabbit_tasks[1:] + db_tasks,
+        manager_tasks[:1],
+        manager_tasks[1:],
+    ]
+
+    timings = []
+    for stage in stages:
+        node_tasks = {}
+        for node, role, start in stage:
+            node_tasks.setdefault(node, []).append((role, start))
+        for node_timings in util.parallel_map(
+            lambda item: _bootstrap_node_roles(*item),
+            node_tasks.items(),
+        ):
+            timings.extend(node_timings)
+
+    if timings:
+        logger = timings[0][0]._logger
+        logger.info('Cluster bootstrap timings:')
+        for _, name, role, duration in timings:
+            logger.info('  %s (%s): %.0fs', name, role, duration)
+
+
+def _bootstrap_node_roles(node, roles):
+    timings = []
+    for role, start in roles:
+        started = time.time()
+        if not start():
+            # This node is in the skip list
             continue
-        while not node.bootstrap_is_complete():
-            node.log_action('Checking bootstrap state')
-            time.sleep(5)
-
-    for node_num, node in enumerate(managers, start=1):
-        _bootstrap_manager_node(node, node_num, dbs, brokers,
-                                skip_bootstrap_list,
-                                pre_cluster_rabbit, high_security,
-                                tempdir, test_config,
-                                use_hostnames, credentials)
+        node.wait_for_bootstrap()
+        if role == 'manager':
+            # Correctly configure the rest client for the node
+            node.client = node.get_rest_client(proto='https')
+        finished = time.time()
+        timeline.record('Cluster bootstrap ({})'.format(role), started,
+                        finished, node.deployment_id)
+        timings.append((node, node.friendly_name, role, finished - started))
+    return timings
 
 
 def _base_prep(node, tempdir):
-    node.run_command(
-        'mkdir -p /tmp/bs_logs'
-    )
-
-    node.run_command(
+    node.run_commands([
+        'mkdir -p /tmp/bs_logs',
         'echo {name} > /tmp/bs_logs/0_node_name'.format(
             name=node.friendly_name,
-        )
-    )
+        ),
+    ])
 
-    ca_base = os.path.join(tempdir, 'ca.')
-    ca_cert = ca_base + 'cert'
-    ca_key = ca_base + 'key'
+    certs = certificates.get_certificate_factory(tempdir)
+    ca_cert, _ = certs.get_ca()
 
-    if not os.path.exists(ca_cert):
-        util.generate_ca_cert(ca_cert, ca_key)
-
-    cert_base = os.path.join(tempdir, '{node_friendly_name}.{extension}')
-
-    node_cert = cert_base.format(node_friendly_name=node.friendly_name,
-                                 extension='crt')
-    node_key = cert_base.format(node_friendly_name=node.friendly_name,
-                                extension='key')
-
-    util.generate_ssl_certificate(
+    node_cert, node_key = certs.get_certificate(
+        node.hostname,
         [node.friendly_name, node.hostname,
          node.private_ip_address,
          node.ip_address],
-        node.hostname,
-        tempdir,
-        node_cert,
-        node_key,
-        ca_cert,
-        ca_key,
     )
 
-    db_client_cert = cert_base.format(node_friendly_name='cloudify',
-                                      extension='crt')
-    db_client_key = cert_base.format(node_friendly_name='cloudify',
-                                     extension='key')
-
     # In case we're using postgres client auth we need a CN of cloudify
-    util.generate_ssl_certificate(
-        [],
-        'cloudify',
-        tempdir,
-        db_client_cert,
-        db_client_key,
-        ca_cert,
-        ca_key,
-    )
-
-    db_su_cert = cert_base.format(node_friendly_name='postgres',
-                                  extension='crt')
-    db_su_key = cert_base.format(node_friendly_name='postgres',
-                                 extension='key')
+    db_client_cert, db_client_key = certs.get_certificate('cloudify')
 
-    # In case we're using postgres client auth we need a CN of cloudify
-    util.generate_ssl_certificate(
-        [],
-        'postgres',
-        tempdir,
-        db_su_cert,
-        db_su_key,
-        ca_cert,
-        ca_key,
-    )
+    # ...and the superuser needs a CN of postgres
+    db_su_cert, db_su_key = certs.get_certificate('postgres')
 
     remote_cert = '/tmp/' + node.friendly_name + '.crt'
     remote_key = '/tmp/' + node.friendly_name + '.key'
     remote_ca = '/tmp/ca.crt'
 
-    node.put_remote_file(
-        local_path=node_cert,
-        remote_path=remote_cert,
-    )
-    node.put_remote_file(
-        local_path=node_key,
-        remote_path=remote_key,
-    )
-    node.put_remote_file(
-        local_path=db_client_cert,
-        remote_path='/tmp/db_client.crt',
-    )
-    node.put_remote_file(
-        local_path=db_client_key,
-        remote_path='/tmp/db_client.key',
-    )
-    node.put_remote_file(
-        local_path=db_su_cert,
-        remote_path='/tmp/db_su.crt',
-    )
-    node.put_remote_file(
-        local_path=db_su_key,
-        remote_path='/tmp/db_su.key',
-    )
-    node.put_remote_file(
-        local_path=ca_cert,
-        remote_path=remote_ca,
-    )
+    node.put_remote_files({
+        remote_cert: node_cert,
+        remote_key: node_key,
+        '/tmp/db_client.crt': db_client_cert,
+        '/tmp/db_client.key': db_client_key,
+        '/tmp/db_su.crt': db_su_cert,
+        '/tmp/db_su.key': db_su_key,
+        remote_ca: ca_cert,
+    })
 
     node.local_cert = node_cert
     node.remote_cert = remote_cert
@@ -651,12 +762,9 @@ def _bootstrap_rabbit_node(node, rabbit_num, brokers, skip_bootstrap_list,
     if credentials:
         util.update_dictionary(node.install_config, credentials)
 
-    if pre_cluster_rabbit and rabbit_num == 1:
-        node.bootstrap(blocking=True, restservice_expected=False,
-                       config_name='rabbit')
-    else:
-        node.bootstrap(blocking=False, restservice_expected=False,
-                       config_name='rabbit')
+    node.bootstrap(blocking=False, restservice_expected=False,
+                   config_name='rabbit')
+    return True
 
 
 def _bootstrap_db_node(node, db_num, dbs, skip_bootstrap_list, high_security,
@@ -720,6 +828,7 @@ def _bootstrap_db_node(node, db_num, dbs, skip_bootstrap_list, high_security,
 
     node.bootstrap(blocking=False, restservice_expected=False,
                    config_name='db')
+    return True
 
 
 def _bootstrap_manager_node(node, mgr_num, dbs, brokers, skip_bootstrap_list,
@@ -830,12 +939,9 @@ def _bootstrap_manager_node(node, mgr_num, dbs, brokers, skip_bootstrap_list,
     if credentials:
         util.update_dictionary(node.install_config, credentials)
 
-    # We have to block on every manager
-    node.bootstrap(blocking=True, restservice_expected=False,
+    node.bootstrap(blocking=False, restservice_expected=False,
                    upload_license=upload_license, config_name='manager')
-
-    # Correctly configure the rest client for the node
-    node.client = node.get_rest_client(proto='https')
+    return True
 
 
 def _add_monitoring_config(node, manager=False):
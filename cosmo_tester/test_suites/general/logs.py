@@ -1,7 +1,17 @@
+import hashlib
 import time
 import subprocess
 from zipfile import ZipFile
 
+from cosmo_tester.framework.util import (
+    get_rest_rate_limiter,
+    parallel_map,
+    wait_until,
+)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+LOCAL_HASH_WORKERS = 8
+
 
 def test_logs_aio(image_based_manager, tmpdir, logger):
     _test_logs([image_based_manager], tmpdir, logger)
@@ -29,12 +39,16 @@ def _test_logs(managers, tmpdir, logger):
 def create_log_bundle(managers, manager_logs_path, dump_name, logger):
 
     logger.info('Creating log dump')
-    managers[0].client.log_bundles.create(dump_name)
-    status = 'creating'
-    while status == 'creating':
-        status = managers[0].client.log_bundles.get(dump_name).get(
-            'status', 'creating'
-        )
+    client = managers[0].client
+    client.log_bundles.create(dump_name)
+
+    def _get_finished_status():
+        status = client.log_bundles.get(dump_name).get('status', 'creating')
+        return None if status == 'creating' else status
+
+    status = wait_until(_get_finished_status, 10 * 60,
+                        'log bundle {}'.format(dump_name), logger=logger,
+                        rate_limiter=get_rest_rate_limiter(client))
     assert status == 'created'
 
     logger.info('Preparing manager logs comparison')
@@ -82,29 +96,39 @@ def compare_local_and_manager_logs(manager, local_logs_base,
     assert local_logs == manager_logs
 
     logger.info('Checking log contents match')
-    mismatches = []
-    for sub_path in local_logs:
-        local_log = local_logs_path + sub_path
-        manager_log = manager_logs_path + sub_path
-
-        with open(local_log, 'rb') as local_handle:
-            local_data = local_handle.read()
-
-        # More data may have been logged after we asked for the bundle, so we
-        # will just truncate it to reach the same time point (ish)
-        local_length = len(local_data)
-        manager.run_command(
-            f"truncate -s '<{local_length}' {manager_log}")
-
-        # Strip both in case of extra newlines in the cat output
-        local_data = local_data.decode('utf8').strip()
-        manager_data = manager.run_command(
-            f'cat {manager_log}', hide_stdout=True).stdout.strip()
-
-        if local_data != manager_data:
-            mismatches.append(sub_path)
-
-    mismatches = ','.join(mismatches)
+    local_manifest = dict(zip(local_logs, parallel_map(
+        lambda sub_path: _hash_local_log(local_logs_path + sub_path),
+        local_logs,
+        max_workers=LOCAL_HASH_WORKERS,
+    )))
+    # More data may have been logged after we asked for the bundle, so we
+    # will just truncate the manager's logs to reach the same time point (ish)
+    manager_hashes = manager.get_remote_file_hashes(
+        [manager_logs_path + sub_path for sub_path in local_logs],
+        truncate_sizes={
+            manager_logs_path + sub_path: length
+            for sub_path, (length, _) in local_manifest.items()
+        },
+    )
+    manager_manifest = {
+        path[len(manager_logs_path):]: digest
+        for path, digest in manager_hashes.items()
+    }
+
+    mismatches = ','.join(
+        sub_path for sub_path in local_logs
+        if local_manifest[sub_path][1] != manager_manifest[sub_path]
+    )
     assert not mismatches, (
         f'The following logs had differences: {mismatches}'
     )
+
+
+def _hash_local_log(path):
+    digest = hashlib.sha256()
+    length = 0
+    with open(path, 'rb') as local_handle:
+        for chunk in iter(lambda: local_handle.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            length += len(chunk)
+    return length, digest.hexdigest()
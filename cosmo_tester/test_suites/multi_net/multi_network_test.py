@@ -1,7 +1,7 @@
-import time
 import pytest
 from copy import deepcopy
 
+from cosmo_tester.framework import util
 from cosmo_tester.framework.test_hosts import Hosts, VM
 from cosmo_tester.framework.examples import get_example_deployment
 from cosmo_tester.test_suites.snapshots import (
@@ -60,10 +60,9 @@ def prepare_managers(managers, logger):
 
         instance.bootstrap(blocking=False, upload_license=True)
 
-    for instance in managers:
-        logger.info('Waiting for bootstrap of {}'.format(instance.server_id))
-        while not instance.bootstrap_is_complete():
-            time.sleep(3)
+    logger.info('Waiting for bootstrap of {}'.format(
+        ', '.join(instance.server_id for instance in managers)))
+    util.wait_for_bootstraps(managers)
 
 
 @pytest.fixture(scope='function')
@@ -105,7 +104,6 @@ def test_multiple_networks(managers_and_vms,
 
     old_manager, new_manager = managers_and_vms[:2]
     snapshot_id = 'multi_net_test_snapshot'
-    local_snapshot_path = str(tmpdir / 'snap.zip')
 
     # One multi-net dep will be used to test a network added post bootstrap
     logger.info('Selecting post-bootstrap network test vm')
@@ -121,7 +119,7 @@ def test_multiple_networks(managers_and_vms,
         example.upload_and_verify_install()
 
     create_copy_and_restore_snapshot(
-        old_manager, new_manager, snapshot_id, local_snapshot_path, logger,
+        old_manager, new_manager, snapshot_id, logger,
         wait_for_post_restore_commands=False)
 
     upgrade_agents(new_manager, logger, test_config)
@@ -1,27 +1,37 @@
+from collections.abc import Mapping
+from contextlib import contextmanager
+import hashlib
 import json
 import os
-from time import sleep
+import time
 
+import requests
 import retrying
 
 from cloudify.snapshots import STATES
+from cloudify_rest_client.executions import Execution
 from cloudify_rest_client.exceptions import (
     CloudifyClientError,
     UserUnauthorizedError,
 )
 
+from cosmo_tester.framework import timeline
 from cosmo_tester.framework.constants import SUPPORTED_RELEASES
 from cosmo_tester.framework.util import (
     assert_snapshot_created,
     ExecutionFailed,
     list_executions,
     list_snapshots,
-    set_client_tenant,
+    parallel_map,
     wait_for_execution,
 )
 
 
 SNAPSHOT_ID = 'testsnapshot'
+SNAPSHOT_ARCHIVE_PATH = (
+    '/opt/manager/resources/snapshots/{snapshot_id}/{snapshot_id}.zip'
+)
+SNAPSHOT_CHUNK_SIZE = 1024 * 1024
 # This is used purely for testing that plugin restores have occurred.
 # Any plugin should work.
 BASE_PLUGIN_PATH = '/opt/mgmtworker/env/plugins/{tenant}/'
@@ -58,10 +68,10 @@ def confirm_manager_empty(manager, logger):
 
     clean = {
         'default_tenant': {
-            'plugins': [],
-            'blueprints': [],
-            'deployments': [],
-            'secrets': [],
+            'plugins': (),
+            'blueprints': (),
+            'deployments': (),
+            'secrets': (),
         }
     }
     logger.info('Confirming default tenant has no resources')
@@ -81,13 +91,11 @@ def create_snapshot(manager, snapshot_id, logger):
 
 
 def create_copy_and_restore_snapshot(old_manager, new_manager,
-                                     snapshot_id, local_snapshot_path,
-                                     logger,
+                                     snapshot_id, logger,
                                      wait_for_post_restore_commands=True,
                                      cert_path=None):
     create_snapshot(old_manager, SNAPSHOT_ID, logger)
-    download_snapshot(old_manager, local_snapshot_path, SNAPSHOT_ID, logger)
-    upload_snapshot(new_manager, local_snapshot_path, SNAPSHOT_ID, logger)
+    copy_snapshot(old_manager, new_manager, SNAPSHOT_ID, logger)
     restore_snapshot(
         new_manager, SNAPSHOT_ID, logger,
         wait_for_post_restore_commands=wait_for_post_restore_commands,
@@ -110,6 +118,81 @@ def upload_snapshot(manager, local_path, snapshot_id, logger):
                 json.dumps(snapshot, indent=2))
 
 
+class SnapshotChecksumError(Exception):
+    """A copied snapshot's checksum didn't match the original archive."""
+
+
+def copy_snapshot(old_manager, new_manager, snapshot_id, logger,
+                  attempts=3):
+    """Stream a snapshot from one manager to another, without a local copy.
+
+    The checksum of what was downloaded is compared with the original
+    archive's before the upload is completed, and the checksum of the copy
+    on the new manager is then compared with it as well. The copy is
+    restarted if either doesn't match or the transfer fails, as snapshot
+    uploads can't be resumed part way through.
+    """
+    uri = '/snapshots/{}/archive'.format(snapshot_id)
+    archive_path = SNAPSHOT_ARCHIVE_PATH.format(snapshot_id=snapshot_id)
+    expected = _get_archive_checksum(old_manager, archive_path)
+    if expected is None:
+        logger.warning('Could not get the snapshot checksum, as the archive '
+                       'is not on the old manager.')
+    for attempt in range(1, attempts + 1):
+        logger.info('Copying snapshot to latest manager (attempt %d)..',
+                    attempt)
+        digest = hashlib.sha256()
+
+        def _stream():
+            response = old_manager.client._client.get(uri, stream=True)
+            try:
+                for chunk in response.bytes_stream(SNAPSHOT_CHUNK_SIZE):
+                    digest.update(chunk)
+                    yield chunk
+            finally:
+                response.close()
+            # Abandon the upload rather than completing it with bad data
+            if expected and digest.hexdigest() != expected:
+                raise SnapshotChecksumError(
+                    'Downloaded snapshot has checksum {}, expected {}'.format(
+                        digest.hexdigest(), expected))
+
+        try:
+            new_manager.client._client.put(uri, data=_stream(),
+                                           expected_status_code=201)
+        except (CloudifyClientError, requests.RequestException,
+                SnapshotChecksumError) as err:
+            logger.warning('Failed to copy snapshot: %s', err)
+        else:
+            copied = _get_archive_checksum(new_manager, archive_path)
+            if copied is None:
+                logger.warning('Could not verify the snapshot checksum, as '
+                               'the archive is not on this manager.')
+                return
+            if copied == (expected or digest.hexdigest()):
+                logger.info('Copied snapshot with checksum %s', copied)
+                return
+            logger.warning('Copied snapshot has checksum %s, expected %s',
+                           copied, expected or digest.hexdigest())
+        try:
+            new_manager.client.snapshots.delete(snapshot_id)
+        except CloudifyClientError:
+            # The upload may have failed before the snapshot was created
+            pass
+    raise RuntimeError('Could not copy snapshot {} after {} attempts.'.format(
+        snapshot_id, attempts))
+
+
+def _get_archive_checksum(manager, archive_path):
+    result = manager.run_command(
+        'sha256sum {}'.format(archive_path),
+        use_sudo=True, warn_only=True, hide_stdout=True,
+    )
+    if not result.ok:
+        return None
+    return result.stdout.split()[0]
+
+
 def change_rest_client_password(manager, new_password):
     manager.client = manager.get_rest_client(password=new_password)
 
@@ -127,7 +210,7 @@ def _retry_if_file_not_found(exception):
 def restore_snapshot(manager, snapshot_id, logger, admin_password,
                      restore_certificates=False, force=False,
                      wait_for_post_restore_commands=True,
-                     wait_timeout=20, cert_path=None, blocking=True):
+                     cert_path=None, blocking=True):
     list_snapshots(manager, logger)
 
     logger.info('Restoring snapshot on latest manager..')
@@ -138,50 +221,91 @@ def restore_snapshot(manager, snapshot_id, logger, admin_password,
     )
 
     if blocking:
-        logger.info('Waiting to give time for snapshot to restore')
-        # Because the DB migrations are really temperamental since 5.0.5, so
-        # let's try to give less activity
-        sleep(60)
-        completed = False
-        password_reset = False
+        with _restore_phase('Snapshot restore execution', manager, logger):
+            logger.info('Waiting to give time for snapshot to restore')
+            # Because the DB migrations are really temperamental since 5.0.5,
+            # so let's try to give less activity. There's nothing we could
+            # probe for their completion without adding to that activity.
+            time.sleep(60)
+            _wait_for_restore_execution(manager, restore_execution, logger,
+                                        admin_password)
+        if wait_for_post_restore_commands:
+            with _restore_phase('Snapshot post-restore commands', manager,
+                                logger):
+                wait_for_restore(manager, logger)
+
+
+@contextmanager
+def _restore_phase(name, manager, logger):
+    start = time.time()
+    with timeline.span(name, manager.deployment_id):
+        yield
+    logger.info('%s took %.1fs', name, time.time() - start)
+
+
+class _ProbeBackoff(object):
+    """Delays between readiness probes.
+    The delay grows while the probed state stays the same, and drops back to
+    the minimum when it changes, as the next change is then likely to follow
+    soon.
+    """
+
+    def __init__(self, timeout, minimum=1, maximum=15):
+        self.deadline = time.time() + timeout
+        self._minimum = minimum
+        self._maximum = maximum
+        self._delay = minimum
+        self._last_state = None
+
+    def wait(self, state):
+        """Wait before the next probe, returning False if out of time."""
+        if state != self._last_state:
+            self._last_state = state
+            self._delay = self._minimum
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(self._delay, remaining))
+        self._delay = min(self._delay * 2, self._maximum)
+        return True
+
+
+def _wait_for_restore_execution(manager, restore_execution, logger,
+                                admin_password, timeout=40 * 60):
+    backoff = _ProbeBackoff(timeout)
+    password_reset = False
+    while True:
         try:
-            # Retry while the password is still being reset
-            attempt = 0
-            while attempt < 60:
-                try:
-                    wait_for_execution(
-                        manager.client,
-                        restore_execution,
-                        logger,
-                        allow_client_error=True)
-                    completed = True
-                    break
-                except UserUnauthorizedError:
-                    # We may see this exception even without the password
-                    # being changed due to rest-security.conf updates
-                    if not password_reset:
-                        change_rest_client_password(manager, admin_password)
-                        update_credentials(manager, logger, admin_password)
-                        password_reset = True
-                    sleep(2)
-                    attempt += 1
-                except CloudifyClientError:
-                    # This will appear sometimes when restservice is
-                    # restarting but nginx is up.
-                    sleep(2)
-                    attempt += 1
-        except ExecutionFailed:
-            logger.error('Snapshot execution failed.')
-            list_executions(manager, logger)
-            raise
-
-        if not completed:
+            status = manager.client.executions.get(
+                restore_execution['id'], _include=['id', 'status'],
+            )['status']
+        except UserUnauthorizedError:
+            # We may see this exception even without the password
+            # being changed due to rest-security.conf updates
+            if not password_reset:
+                change_rest_client_password(manager, admin_password)
+                update_credentials(manager, logger, admin_password)
+                password_reset = True
+            status = 'unauthorized'
+        except (CloudifyClientError, requests.RequestException):
+            # This will appear sometimes when restservice is
+            # restarting but nginx is up.
+            status = 'restservice unavailable'
+        else:
+            if status in Execution.END_STATES:
+                break
+        if not backoff.wait(status):
             raise RuntimeError('Snapshot restore did not succeed in time.')
+        logger.info('Snapshot restore execution is: %s', status)
 
-        # wait a while to allow the restore-snapshot post-workflow commands to
-        # run
-        if wait_for_post_restore_commands:
-            sleep(wait_timeout)
+    try:
+        # This will show the events if the restore failed
+        wait_for_execution(manager.client, restore_execution, logger,
+                           allow_client_error=True)
+    except ExecutionFailed:
+        logger.error('Snapshot execution failed.')
+        list_executions(manager, logger)
+        raise
 
 
 def prepare_credentials_tests(manager, logger):
@@ -280,40 +404,125 @@ def verify_services_status(manager, logger):
                             format(instance, instance['state']))
 
 
-def get_manager_state(manager, tenants, logger):
-    tenant_state = {}
-    for tenant in tenants:
-        tenant_state[tenant] = {}
-
-        logger.info('Getting plugin details for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['plugins'] = sorted([
-                (
-                    item['package_name'],
-                    item['package_version'],
-                    item['distribution'],
-                )
-                for item in manager.client.plugins.list()
-            ])
+# How each kind of resource is identified when comparing manager states
+STATE_RESOURCES = {
+    'plugins': (
+        lambda client: client.plugins,
+        ('package_name', 'package_version', 'distribution'),
+    ),
+    'blueprints': (lambda client: client.blueprints, ('id',)),
+    'deployments': (lambda client: client.deployments, ('id',)),
+    'secrets': (lambda client: client.secrets, ('key',)),
+}
+
+
+class ManagerState(Mapping):
+    """The resources on a manager, by tenant and then by resource type.
+    This is immutable and hashable, so states can be compared or stored
+    cheaply.
+    """
+
+    def __init__(self, tenant_states):
+        self._states = {
+            tenant: _FrozenMapping(resources)
+            for tenant, resources in tenant_states.items()
+        }
+        self._hash = None
+
+    def __getitem__(self, tenant):
+        return self._states[tenant]
+
+    def __iter__(self):
+        return iter(self._states)
 
-        logger.info('Getting blueprints for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['blueprints'] = sorted([
-                item['id'] for item in manager.client.blueprints.list()
-            ])
+    def __len__(self):
+        return len(self._states)
 
-        logger.info('Getting deployments for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['deployments'] = sorted([
-                item['id'] for item in manager.client.deployments.list()
-            ])
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._states.items()))
+        return self._hash
 
-        logger.info('Getting secrets for tenant %s', tenant)
-        with set_client_tenant(manager.client, tenant):
-            tenant_state[tenant]['secrets'] = sorted([
-                item['key'] for item in manager.client.secrets.list()
-            ])
-    return tenant_state
+    def __repr__(self):
+        return 'ManagerState({!r})'.format(
+            {tenant: dict(state) for tenant, state in self._states.items()})
+
+    def diff(self, other):
+        """Get the resources which are only in this state or only in the
+        other one, as {(tenant, resource type): (ours, theirs)}.
+        """
+        differences = {}
+        for tenant in set(self) | set(other):
+            ours = self.get(tenant, {})
+            theirs = other.get(tenant, {})
+            for resource_type in set(ours) | set(theirs):
+                ours_only = set(ours.get(resource_type, ()))
+                theirs_only = set(theirs.get(resource_type, ()))
+                ours_only, theirs_only = (ours_only - theirs_only,
+                                          theirs_only - ours_only)
+                if ours_only or theirs_only:
+                    differences[(tenant, resource_type)] = (
+                        sorted(ours_only), sorted(theirs_only))
+        return differences
+
+
+class _FrozenMapping(Mapping):
+    def __init__(self, items):
+        self._items = dict(items)
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __hash__(self):
+        return hash(frozenset(self._items.items()))
+
+
+def get_manager_state(manager, tenants, logger):
+    """Get the resources in each of these tenants, as a ManagerState.
+    Each resource type is listed for all tenants at once, in parallel.
+    """
+    logger.info('Getting %s for tenants %s',
+                ', '.join(STATE_RESOURCES), ', '.join(tenants))
+    resource_types = sorted(STATE_RESOURCES)
+    listed = parallel_map(
+        lambda resource_type: _list_state_resources(
+            manager.client, resource_type),
+        resource_types,
+    )
+
+    tenant_state = {tenant: {} for tenant in tenants}
+    for resource_type, resources in zip(resource_types, listed):
+        for tenant in tenants:
+            # Global resources are visible in every tenant
+            tenant_state[tenant][resource_type] = tuple(sorted(
+                key for key, owner, visibility in resources
+                if owner == tenant or visibility == 'global'
+            ))
+    return ManagerState(tenant_state)
+
+
+def _list_state_resources(client, resource_type):
+    get_api, key_fields = STATE_RESOURCES[resource_type]
+    items = get_api(client).list(
+        _include=list(key_fields) + ['tenant_name', 'visibility'],
+        _all_tenants=True,
+        _get_all_results=True,
+    )
+    return [
+        (
+            item[key_fields[0]] if len(key_fields) == 1
+            else tuple(item[field] for field in key_fields),
+            item['tenant_name'],
+            item['visibility'],
+        )
+        for item in items
+    ]
 
 
 def _log(message, logger, tenant=None):
@@ -326,9 +535,20 @@ def _log(message, logger, tenant=None):
 # post-restore commands finish running, so we'll give it time
 # create-admin-token is rarely taking 1.5+ minutes to execute, so three
 # minutes are allowed for it
-@retrying.retry(stop_max_attempt_number=36, wait_fixed=5000)
-def wait_for_restore(manager, logger):
-    restore_status = manager.client.snapshots.get_status()
-    logger.info('Current snapshot status: %s, waiting for %s',
-                restore_status, STATES.NOT_RUNNING)
-    assert STATES.NOT_RUNNING == restore_status['status']
+def wait_for_restore(manager, logger, timeout=3 * 60):
+    """Wait until the snapshot restore is finished and restservice is up."""
+    backoff = _ProbeBackoff(timeout, maximum=5)
+    while True:
+        try:
+            restore_status = manager.client.snapshots.get_status()['status']
+            if restore_status == STATES.NOT_RUNNING:
+                manager.client.manager.get_status()
+                return
+        except (CloudifyClientError, requests.RequestException) as err:
+            restore_status = 'restservice unavailable: {}'.format(err)
+        logger.info('Current snapshot status: %s, waiting for %s',
+                    restore_status, STATES.NOT_RUNNING)
+        if not backoff.wait(restore_status):
+            raise RuntimeError(
+                'Snapshot status was still {} after {}s.'.format(
+                    restore_status, timeout))
@@ -34,7 +34,7 @@ TENANTS = [FROM_SOURCE_TENANT, WIN_TENANT, LIN_TENANT,
 
 
 def test_restore_snapshot_and_agents_upgrade_multitenant(
-        hosts, logger, tmpdir, ssh_key, test_config):
+        hosts, logger, ssh_key, test_config):
     if not test_config['premium']:
         pytest.skip('Multi tenant snapshots are not valid for community.')
 
@@ -62,8 +62,6 @@ def test_restore_snapshot_and_agents_upgrade_multitenant(
 
         confirm_manager_empty(new_manager, logger)
 
-        local_snapshot_path = str(tmpdir / 'snapshot-{}.zip'.format(old_ver))
-
         example_mappings = prepare_old_manager_resources(old_mgr, logger,
                                                          ssh_key, test_config,
                                                          win_vm, lin_vm)
@@ -93,7 +91,7 @@ def test_restore_snapshot_and_agents_upgrade_multitenant(
         prepare_credentials_tests(old_mgr, logger)
 
         create_copy_and_restore_snapshot(
-            old_mgr, new_manager, SNAPSHOT_ID, local_snapshot_path,
+            old_mgr, new_manager, SNAPSHOT_ID,
             logger, wait_for_post_restore_commands=False)
 
         verify_services_status(new_manager, logger)
@@ -130,7 +128,8 @@ def test_restore_snapshot_and_agents_upgrade_multitenant(
             example.check_files()
 
         new_manager_state = get_manager_state(new_manager, TENANTS, logger)
-        assert new_manager_state == old_manager_state
+        assert new_manager_state == old_manager_state, (
+            new_manager_state.diff(old_manager_state))
         check_deployments(new_manager, old_manager_state, logger)
 
         upgrade_agents(new_manager, logger, test_config)
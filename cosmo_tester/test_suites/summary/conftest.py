@@ -6,8 +6,9 @@ import pytest
 from cloudify_rest_client.exceptions import CloudifyClientError
 from cosmo_tester.framework.test_hosts import Hosts
 from cosmo_tester.framework.util import (
-    create_deployment,
-    set_client_tenant,
+    get_tenant_client,
+    parallel_map,
+    seed_deployments,
 )
 
 from . import DEPLOYMENTS_PER_SITE
@@ -49,6 +50,27 @@ TENANT_DEPLOYMENT_COUNTS = {
 }
 
 
+def _get_seed_deployments(deployment_counts):
+    """Get the (blueprint, deployment ID) pairs to seed a tenant with."""
+    return [
+        (bp_name, bp_name + str(i))
+        for bp_name, count in deployment_counts.items()
+        for i in range(count)
+    ]
+
+
+def _seed_tenant(manager, tenant, logger):
+    client = get_tenant_client(manager.client, tenant)
+    for blueprint, bp_path in BLUEPRINTS.items():
+        client.blueprints.upload(
+            path=bp_path,
+            entity_id=blueprint,
+        )
+    deployments = _get_seed_deployments(TENANT_DEPLOYMENT_COUNTS[tenant])
+    seed_deployments(client, deployments, logger)
+    return deployments
+
+
 def _create_sites(manager, deployment_ids):
     for site_dep_count in DEPLOYMENTS_PER_SITE:
         site_name = site_dep_count['site_name']
@@ -82,31 +104,14 @@ def prepared_manager(request, ssh_key, session_tmpdir, test_config,
                 except CloudifyClientError:
                     time.sleep(2)
 
+        # Each tenant is seeded at the same time
         deployment_ids = []
-        for tenant in tenants:
-            with set_client_tenant(manager.client, tenant):
-                for blueprint, bp_path in BLUEPRINTS.items():
-                    manager.client.blueprints.upload(
-                        path=bp_path,
-                        entity_id=blueprint,
-                    )
-
-                for bp_name, count in TENANT_DEPLOYMENT_COUNTS[tenant].items():
-                    for i in range(count):
-                        deployment_id = bp_name + str(i)
-                        create_deployment(
-                            manager.client, bp_name, deployment_id,
-                            session_logger,
-                        )
-                        deployment_ids.append(deployment_id)
-                    manager.wait_for_all_executions()
-                    for i in range(count):
-                        deployment_id = bp_name + str(i)
-                        manager.client.executions.start(
-                            deployment_id,
-                            'install',
-                        )
-                    manager.wait_for_all_executions()
+        for deployments in parallel_map(
+            lambda tenant: _seed_tenant(manager, tenant, session_logger),
+            tenants,
+        ):
+            deployment_ids.extend(
+                deployment_id for _, deployment_id in deployments)
 
         _create_sites(manager, deployment_ids)
         yield manager
@@ -25,6 +25,7 @@ setup(
     description='Cosmo system tests framework',
     install_requires=[
         'cffi<1.15',
+        'cryptography',
         'fabric',
         'PyYAML',
         'requests>=2.7.0,<3.0.0',